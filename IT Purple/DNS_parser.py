@@ -1,207 +1,921 @@
-import pickle
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import queue
+import sqlite3
 import sys
+import threading
 
+import requests
+from lxml import etree, html as lxml_html
+from itertools import islice
 from openpyxl import Workbook
-from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, Side
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from random import randint
 from datetime import datetime
-from time import sleep as pause
-from bs4 import BeautifulSoup
+from time import monotonic, sleep as pause, time
+from urllib.parse import urlparse
 import undetected_chromedriver as uc
-
-
-def parse_characteristics_page(driver, url):
-    """ Парсит страницу товара по ссылке."""
-    driver.get(url)
-    pause(randint(7, 11))
-    soup = BeautifulSoup(driver.page_source, 'lxml')
-
-
-    name = soup.find('div', class_="product-card-description__title")
-    price = soup.find('div', class_="product-buy__price")
-    desc = soup.find('div', class_="product-card-description-text")
-    avail = soup.find('a', class_="order-avail-wrap__link ui-link ui-link_blue")
-    charcs = soup.find_all('div', class_="product-characteristics__spec-title")
-    cvalue = soup.find_all('div', class_="product-characteristics__spec-value")
-    main_picture = soup.find('img', class_="product-images-slider__main-img")
-    pictures_soup = soup.find_all('img', class_="product-images-slider__img loaded tns-complete")
-
-    pictures_list = []
-    for i in pictures_soup:
-        _ = pictures_list.append(i.get('data-src'))
-        if _ is not None:
-            pictures_list.append(_)
-
-    span_tags = soup.find_all('span')
-    for i in span_tags:
-        if bool(str(i).find('data-go-back-catalog') != -1):
-            category = i
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Адрес магазина, можно подменить на локальный сервер с сохранёнными страницами
+DNS_BASE_URL = os.environ.get('DNS_BASE_URL', 'https://www.dns-shop.ru')
+
+# Количество параллельных браузеров и общий бюджет запросов в минуту
+WORKERS = 4
+REQUESTS_PER_MINUTE = 40
+# Отдельные лимиты (запросов в минуту) для доменов
+DOMAIN_RATE_LIMITS = {
+    urlparse(DNS_BASE_URL).netloc: 30,
+}
+# Сколько секунд ждать отрисовки цены на странице товара
+RENDER_TIMEOUT = 15
+
+# Чем загружать страницы на каждом этапе: 'http' — обычным запросом
+# (Chrome запускается, только если без JavaScript страница не разобралась),
+# 'browser' — сразу через Chrome
+FETCH_BACKENDS = {
+    'category': 'http',
+    'product': 'http',
+}
+HTTP_TIMEOUT = 20
+HTTP_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',
+}
+
+# Товаров на одной странице категории и сколько страниц категорий
+# загружать одновременно
+PAGE_SIZE = 18
+PAGINATION_CONCURRENCY = 4
+
+# Журнал обхода: после падения повторный запуск продолжает с того же места
+JOURNAL_FILE = 'crawl_journal.sqlite3'
+# Сколько записей копить в памяти перед сбросом в журнал
+JOURNAL_BATCH_SIZE = 50
+# Инкрементальный режим: товары с прежней ценой в листинге и ответом 304
+# не парсятся заново, а изменения пишутся в отдельный файл
+INCREMENTAL = True
+
+# Форматы выгрузки (xlsx, csv, parquet) и размер пачки для Parquet
+EXPORT_FORMATS = ['xlsx']
+EXPORT_BATCH_SIZE = 1000
+
+# Колоночное хранилище товаров последнего обхода
+STORE_FILE = 'products.parquet'
+
+COLUMN_NAMES = [
+    "Категория",
+    "Наименование",
+    "Цена",
+    "Доступность",
+    "Ссылка на товар",
+    "Описание",
+    "Главное изображение",
+    "Лист с картинками",
+    "Характеристики",
+]
+
+
+# Признак ответа 304 Not Modified на условный запрос
+NOT_MODIFIED = object()
+
+
+def _by_class(tag, class_name):
+    """ XPath для тега с указанным CSS-классом (среди прочих классов)."""
+    return (f'//{tag}[contains(concat(" ", normalize-space(@class), " "), '
+            f'" {class_name} ")]')
+
+
+# Селекторы компилируются один раз при импорте модуля
+PRODUCT_XPATH = {
+    'name': etree.XPath(_by_class('div', 'product-card-description__title')),
+    'price': etree.XPath(_by_class('div', 'product-buy__price')),
+    'desc': etree.XPath(_by_class('div', 'product-card-description-text')),
+    'avail': etree.XPath('//a[@class="order-avail-wrap__link ui-link ui-link_blue"]'),
+    'charcs': etree.XPath(_by_class('div', 'product-characteristics__spec-title')),
+    'cvalue': etree.XPath(_by_class('div', 'product-characteristics__spec-value')),
+    'main_picture': etree.XPath(_by_class('img', 'product-images-slider__main-img') + '/@src'),
+    'pictures': etree.XPath('//img[@class="product-images-slider__img loaded tns-complete"]/@data-src'),
+    'category': etree.XPath('//span[@data-go-back-catalog]'),
+}
+LISTING_XPATH = {
+    'items_count': etree.XPath('//span[@data-role="items-count"]'),
+    'links': etree.XPath('//a[@class="catalog-product__name ui-link ui-link_black"]/@href'),
+    'cards': etree.XPath(_by_class('div', 'catalog-product')),
+    'card_link': etree.XPath('.//a[@class="catalog-product__name ui-link ui-link_black"]/@href'),
+    'card_price': etree.XPath('.' + _by_class('div', 'product-buy__price')),
+}
+
+
+class RateLimiter:
+    """ Ограничивает частоту запросов: общий бюджет в минуту и лимиты по доменам.
+
+    Каждый вызов wait() резервирует ближайший свободный слот, поэтому
+    потоки не выстраиваются в очередь на одной блокировке во время сна.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, domain_limits=None):
+        self.interval = 60 / requests_per_minute
+        self.domain_intervals = {
+            domain: 60 / limit for domain, limit in (domain_limits or {}).items()
+        }
+        self.next_slot = 0.0
+        self.domain_next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        domain = urlparse(url).netloc
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.next_slot, self.domain_next_slot.get(domain, 0.0))
+            self.next_slot = slot + self.interval
+            if domain in self.domain_intervals:
+                self.domain_next_slot[domain] = slot + self.domain_intervals[domain]
+        if slot > now:
+            pause(slot - now)
+
+
+def make_http_session(pool_size=WORKERS):
+    """ Создаёт HTTP-сессию с пулом соединений на pool_size потоков."""
+    session = requests.Session()
+    session.headers.update(HTTP_HEADERS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class PageFetcher:
+    """ Загружает страницы для одного потока.
+
+    Страницы этапов с бэкендом 'http' запрашиваются через общую сессию,
+    а Chrome запускается лениво — только когда страницу без JavaScript
+    разобрать не удалось.
+    """
+
+    # uc.Chrome() патчит chromedriver на диске, поэтому браузеры запускаем по одному
+    start_lock = threading.Lock()
+
+    def __init__(self, session, limiter, backends=None):
+        self.session = session
+        self.limiter = limiter
+        self.backends = FETCH_BACKENDS if backends is None else backends
+        self.driver = None
+        # ETag и Last-Modified последнего ответа для условных запросов
+        self.validators = (None, None)
+
+    def http_get(self, url, headers=None):
+        self.limiter.wait(url)
+        response = self.session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response
+
+    def browser_html(self, url, wait_for_class=None):
+        if self.driver is None:
+            with self.start_lock:
+                self.driver = uc.Chrome()
+        self.limiter.wait(url)
+        self.driver.get(url)
+        if wait_for_class is not None:
+            try:
+                WebDriverWait(self.driver, RENDER_TIMEOUT).until(
+                    expected_conditions.presence_of_element_located(
+                        (By.CLASS_NAME, wait_for_class)))
+            except TimeoutException:
+                pass
+        return self.driver.page_source
+
+    def fetch(self, stage, url, parse, wait_for_class=None, on_fetched=None, headers=None):
+        """ Загружает страницу этапа stage и разбирает её функцией parse.
+
+        parse возвращает None, если на странице нет нужных данных;
+        тогда страница повторно загружается через Chrome.
+        on_fetched(url) вызывается, когда HTML страницы получен.
+        headers — заголовки условного запроса; если сервер ответил
+        304 Not Modified, возвращается NOT_MODIFIED.
+        """
+        self.validators = (None, None)
+        if self.backends.get(stage) == 'http':
+            try:
+                response = self.http_get(url, headers)
+            except requests.RequestException as error:
+                print(f'HTTP-запрос к {url} не удался ({error}), пробуем через браузер')
+            else:
+                if response.status_code == 304:
+                    return NOT_MODIFIED
+                if on_fetched is not None:
+                    on_fetched(url)
+                result = parse(response.text, url)
+                if result is not None:
+                    self.validators = (response.headers.get('ETag'),
+                                       response.headers.get('Last-Modified'))
+                    return result
+        html = self.browser_html(url, wait_for_class)
+        if on_fetched is not None:
+            on_fetched(url)
+        result = parse(html, url)
+        if result is None:
+            raise ValueError(f'Не удалось разобрать страницу {url}')
+        return result
+
+    def close(self):
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+
+
+def product_hash(notebook):
+    """ Хэш содержимого товара для поиска изменений между запусками."""
+    data = json.dumps(notebook, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class CrawlJournal:
+    """ Журнал обхода в SQLite.
+
+    Хранит обработанные категории, статус каждой ссылки на товар
+    (discovered, fetched, parsed, failed) и распарсенные товары.
+    Записи копятся в буфере и сбрасываются в базу пачками по batch_size,
+    поэтому весь дамп никогда не держится в памяти.
+
+    Между запусками сохраняются товары и их состояние (хэш, цена,
+    наличие, ETag/Last-Modified). По нему у каждой ссылки текущего
+    запуска отмечается изменение: new, changed или unchanged, а при
+    incremental=True товары с прежней ценой в листинге не загружаются.
+    """
+
+    def __init__(self, path=JOURNAL_FILE, batch_size=JOURNAL_BATCH_SIZE, incremental=INCREMENTAL):
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS categories (
+                url TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                category TEXT,
+                listing_price INTEGER,
+                status TEXT NOT NULL,
+                change TEXT,
+                error TEXT,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS products (
+                url TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS product_state (
+                url TEXT PRIMARY KEY,
+                category TEXT,
+                hash TEXT NOT NULL,
+                price INTEGER,
+                availability TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                last_seen REAL NOT NULL
+            );
+        """)
+        self.connection.commit()
+
+    def _write(self, sql, params):
+        with self.lock:
+            self.buffer.append((sql, params))
+            if len(self.buffer) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        with self.connection:
+            for sql, params in self.buffer:
+                self.connection.execute(sql, params)
+        self.buffer.clear()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def category_done(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT 1 FROM categories WHERE url = ?', (url,)).fetchone()
+        return row is not None
+
+    def add_discovered(self, category, items):
+        """ Записывает найденные в категории пары (ссылка, цена в листинге).
+
+        Возвращает ссылки, которых в журнале ещё не было и которые нужно
+        загрузить. В инкрементальном режиме товар, цена которого в листинге
+        не изменилась, сразу отмечается неизменившимся.
+        """
+        added = []
+        with self.lock:
+            self._flush()
+            with self.connection:
+                for url, listing_price in items:
+                    cursor = self.connection.execute(
+                        'INSERT OR IGNORE INTO urls (url, category, listing_price, status, updated) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (url, category, listing_price, 'discovered', time()))
+                    if not cursor.rowcount:
+                        continue
+                    if self.incremental and listing_price is not None:
+                        row = self.connection.execute(
+                            'SELECT price FROM product_state WHERE url = ?', (url,)).fetchone()
+                        if row is not None and row[0] == listing_price:
+                            self._set_unchanged(url)
+                            continue
+                    added.append(url)
+        return added
+
+    def mark_category_done(self, url):
+        with self.lock:
+            self._flush()
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO categories (url) VALUES (?)', (url,))
+
+    def pending_urls(self):
+        """ Ссылки, которые ещё не распарсены (включая упавшие в прошлый раз)."""
+        with self.lock:
+            return [url for url, in self.connection.execute(
+                "SELECT url FROM urls WHERE status != 'parsed' ORDER BY rowid")]
+
+    def conditional_headers(self, url):
+        """ Заголовки условного запроса по сохранённым ETag и Last-Modified."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT etag, last_modified FROM product_state WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            if row[0]:
+                headers['If-None-Match'] = row[0]
+            if row[1]:
+                headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def mark_fetched(self, url):
+        self._write('UPDATE urls SET status = ?, updated = ? WHERE url = ?',
+                    ('fetched', time(), url))
+
+    def mark_failed(self, url, error):
+        self._write('UPDATE urls SET status = ?, error = ?, updated = ? WHERE url = ?',
+                    ('failed', str(error), time(), url))
+
+    def _set_unchanged(self, url):
+        now = time()
+        self.connection.execute(
+            'UPDATE urls SET status = ?, change = ?, error = NULL, updated = ? WHERE url = ?',
+            ('parsed', 'unchanged', now, url))
+        self.connection.execute(
+            'UPDATE product_state SET last_seen = ? WHERE url = ?', (now, url))
+
+    def mark_unchanged(self, url):
+        """ Товар не изменился с прошлого запуска (например, ответ 304)."""
+        with self.lock:
+            self._flush()
+            with self.connection:
+                self._set_unchanged(url)
+
+    def save_product(self, url, notebook, validators=(None, None)):
+        digest = product_hash(notebook)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT hash FROM product_state WHERE url = ?', (url,)).fetchone()
+            category, = self.connection.execute(
+                'SELECT category FROM urls WHERE url = ?', (url,)).fetchone() or (None,)
+        if row is None:
+            change = 'new'
+        elif row[0] != digest:
+            change = 'changed'
+        else:
+            change = 'unchanged'
+
+        etag, last_modified = validators
+        self._write('INSERT OR REPLACE INTO products (url, data) VALUES (?, ?)',
+                    (url, json.dumps(notebook, ensure_ascii=False)))
+        self._write('INSERT OR REPLACE INTO product_state '
+                    '(url, category, hash, price, availability, etag, last_modified, last_seen) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, category, digest, notebook["Цена"], notebook["Доступность"],
+                     etag, last_modified, time()))
+        self._write('UPDATE urls SET status = ?, change = ?, error = NULL, updated = ? WHERE url = ?',
+                    ('parsed', change, time(), url))
+
+    @staticmethod
+    def _load(data):
+        notebook = json.loads(data)
+        notebook["Характеристики"] = [tuple(pair) for pair in notebook["Характеристики"]]
+        return notebook
+
+    def iter_products(self):
+        """ Построчно отдаёт товары текущего запуска, сгруппированные по категориям
+        в порядке обнаружения ссылок."""
+        self.flush()
+        cursor = self.connection.execute(
+            "SELECT products.data FROM urls JOIN products ON products.url = urls.url "
+            "WHERE urls.status = 'parsed' ORDER BY urls.category, urls.rowid")
+        for data, in cursor:
+            yield self._load(data)
+
+    def removed_urls(self):
+        """ Товары, которые были в обработанных категориях раньше, но не нашлись сейчас."""
+        self.flush()
+        return [url for url, in self.connection.execute(
+            "SELECT url FROM product_state "
+            "WHERE category IN (SELECT url FROM categories) "
+            "AND url NOT IN (SELECT url FROM urls)")]
+
+    def iter_delta(self):
+        """ Отдаёт пары (изменение, товар) для новых и изменившихся товаров
+        и (removed, ссылка) для пропавших."""
+        self.flush()
+        cursor = self.connection.execute(
+            "SELECT urls.change, products.data FROM urls JOIN products ON products.url = urls.url "
+            "WHERE urls.status = 'parsed' AND urls.change IN ('new', 'changed') ORDER BY urls.rowid")
+        for change, data in cursor:
+            yield change, self._load(data)
+        for url in self.removed_urls():
+            yield 'removed', url
+
+    def finish_run(self):
+        """ Завершает обход: забывает пропавшие товары и очищает статусы
+        ссылок, сохраняя товары и их состояние для следующего запуска."""
+        removed = self.removed_urls()
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    'DELETE FROM product_state WHERE url = ?', [(url,) for url in removed])
+                self.connection.executemany(
+                    'DELETE FROM products WHERE url = ?', [(url,) for url in removed])
+                self.connection.execute('DELETE FROM categories')
+                self.connection.execute('DELETE FROM urls')
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def _text(element):
+    return element.text_content().strip()
+
+
+def parse_product_html(html, url):
+    """ Разбирает HTML страницы товара.
+
+    Возвращает None, если в разметке нет названия, цены или категории —
+    значит, страница отрисовывается JavaScript-ом.
+    """
+    tree = lxml_html.fromstring(html)
+
+    name = PRODUCT_XPATH['name'](tree)
+    price = PRODUCT_XPATH['price'](tree)
+    category = PRODUCT_XPATH['category'](tree)
+    if not name or not price or not category:
+        return None
+
+    desc = PRODUCT_XPATH['desc'](tree)
+    avail = PRODUCT_XPATH['avail'](tree)
+    main_picture = PRODUCT_XPATH['main_picture'](tree)
+    pictures_list = [src for src in PRODUCT_XPATH['pictures'](tree) if src]
 
     tech_spec = {}
-    for f1, f2 in zip(charcs, cvalue):
-        tech_spec[f1.text.rstrip().lstrip()] = f2.text.rstrip().lstrip()
+    for f1, f2 in zip(PRODUCT_XPATH['charcs'](tree), PRODUCT_XPATH['cvalue'](tree)):
+        tech_spec[_text(f1)] = _text(f2)
 
     notebook = {}
 
-    notebook["Категория"] = category.text.lstrip(': ')
-    notebook["Наименование"] = name.text[15:]
-    notebook["Цена"] = int(price.text.replace(' ', '')[:-1])
-    notebook["Доступность"] = avail.text if avail is not None else 'Товара нет в наличии'
+    notebook["Категория"] = category[-1].text_content().lstrip(': ')
+    notebook["Наименование"] = name[0].text_content()[15:]
+    notebook["Цена"] = int(price[0].text_content().replace(' ', '')[:-1])
+    notebook["Доступность"] = avail[0].text_content() if avail else 'Товара нет в наличии'
     notebook["Ссылка на товар"] = url
-    notebook["Описание"] = desc.text
-    notebook["Главное изображение"] = main_picture.get('src') if main_picture is not None else 'У товара нет картинок'
+    notebook["Описание"] = desc[0].text_content() if desc else ''
+    notebook["Главное изображение"] = str(main_picture[0]) if main_picture else 'У товара нет картинок'
     notebook["Лист с картинками"] = pictures_list
     notebook["Характеристики"] = list(tech_spec.items())
 
-    # for i, j in notebook.items():
-    #     print(i, j)
     return notebook
 
 
-def get_all_category_page_urls(driver, url_to_parse):
-    """ Получаем URL категории и парсим ссылки с неё."""
-    page = 1
-    url = url_to_parse.format(page=page)
-    driver.get(url=url)
-    pause(10)
+def _listing_price(card):
+    """ Цена из карточки листинга; None, если её нет (ещё не отрисована)."""
+    prices = LISTING_XPATH['card_price'](card)
+    if not prices:
+        return None
+    digits = ''.join(x for x in prices[0].text_content().split('₽')[0] if x.isdigit())
+    return int(digits) if digits else None
 
-    soup = BeautifulSoup(driver.page_source, 'lxml')
 
-    span_tags = soup.find_all('span')
-    for i in span_tags:
-        if bool(str(i).find('data-role="items-count"') != -1):
-            number_of_pages = [int(x) for x in str(i) if x.isdigit()]
+def _product_url(href):
+    return DNS_BASE_URL + href + 'characteristics/'
 
-    res = int(''.join(map(str, number_of_pages)))
-    pages_total = ((res // 18) + 1)
-    print(f'Всего в категории {pages_total} страницы')
 
-    urls = []
+def parse_listing_html(html, url=None):
+    """ Разбирает страницу категории.
 
-    while True:
-        page_urls = get_urls_from_page(driver)
-        urls += page_urls
+    Возвращает (число товаров или None, список пар (ссылка на товар,
+    цена в листинге или None)) либо None, если ссылок в разметке нет.
+    """
+    tree = lxml_html.fromstring(html)
+    items = []
+    for card in LISTING_XPATH['cards'](tree):
+        links = LISTING_XPATH['card_link'](card)
+        if links:
+            items.append((_product_url(links[0]), _listing_price(card)))
+    if not items:
+        items = [(_product_url(href), None) for href in LISTING_XPATH['links'](tree)]
+    if not items:
+        return None
 
-        if page >= pages_total:
-            break
+    items_count = None
+    spans = LISTING_XPATH['items_count'](tree)
+    if spans:
+        digits = ''.join(x for x in spans[-1].text_content() if x.isdigit())
+        items_count = int(digits) if digits else None
+    return items_count, items
 
-        page += 1
-        url = url_to_parse.format(page=page)
-        driver.get(url)
-        pause(randint(6, 9))
 
-    return urls
+async def iter_category_pages(fetchers, url_to_parse):
+    """ Асинхронно отдаёт со страниц категории списки пар (ссылка, цена в листинге).
 
+    Первая страница загружается сразу, по ней считается число страниц,
+    остальные загружаются параллельно. fetchers — asyncio.Queue свободных
+    PageFetcher, её размер ограничивает число одновременных загрузок.
+    Вместо страницы, которую не удалось загрузить, отдаётся None.
+    """
 
-def get_urls_from_page(driver):
-    """ Собирает все ссылки на текущей странице. """
-    soup = BeautifulSoup(driver.page_source, 'lxml')
-    elements = soup.find_all('a', class_="catalog-product__name ui-link ui-link_black")
-    return list(map(
-        lambda element: 'https://www.dns-shop.ru' + element.get("href") + 'characteristics/',
-        elements
-    ))
+    async def fetch_page(page):
+        url = url_to_parse.format(page=page)
+        fetcher = await fetchers.get()
+        try:
+            return await asyncio.to_thread(fetcher.fetch, 'category', url,
+                                           parse_listing_html, 'catalog-product__name')
+        except Exception as error:
+            print(f'Не удалось загрузить страницу {url}: {error}')
+            return None
+        finally:
+            fetchers.put_nowait(fetcher)
+
+    first_page = await fetch_page(1)
+    if first_page is None:
+        yield None
+        return
+    items_count, items = first_page
+    yield items
+
+    pages_total = ((items_count // PAGE_SIZE) + 1) if items_count else 1
+    print(f'Всего в категории {pages_total} страницы')
 
+    tasks = [asyncio.create_task(fetch_page(page)) for page in range(2, pages_total + 1)]
+    for task in asyncio.as_completed(tasks):
+        result = await task
+        yield None if result is None else result[1]
 
-def to_excel(data, file_name="table"):
 
-    workbook = Workbook()
-    sheet = workbook.active
-    print('=' * 20)
-    print('Начался экспорт в Excel Таблицу')
-
-    column_names = [
-            "Категория",
-            "Наименование",
-            "Цена",
-            "Доступность",
-            "Ссылка на товар",
-            "Описание",
-            "Главное изображение",
-            "Лист с картинками",
-            "Характеристики",
-    ]
+async def discover_product_urls(categories, journal, session, limiter, tasks):
+    """ Обходит категории и сразу кладёт новые ссылки на товары в очередь tasks.
+
+    Категории обходятся параллельно, одновременных загрузок страниц
+    не больше PAGINATION_CONCURRENCY. Категория отмечается в журнале
+    обработанной, только если загрузились все её страницы.
+    """
+    fetchers = asyncio.Queue()
+    for _ in range(PAGINATION_CONCURRENCY):
+        fetchers.put_nowait(PageFetcher(session, limiter))
+
+    async def discover(index, url):
+        if journal.category_done(url):
+            print(f'Ссылки из {index+1} категории уже в журнале, пропускаем')
+            return
+        print(f'Получение списка всех ссылок из {index+1} категории:')
+        complete = True
+        async for page_items in iter_category_pages(fetchers, url):
+            if page_items is None:
+                complete = False
+                continue
+            for product_url in journal.add_discovered(url, page_items):
+                tasks.put(product_url)
+        if complete:
+            journal.mark_category_done(url)
+
+    try:
+        await asyncio.gather(*(discover(index, url) for index, url in enumerate(categories)))
+    finally:
+        while not fetchers.empty():
+            fetchers.get_nowait().close()
+
+
+def crawl_pool(tasks, journal, workers=WORKERS, limiter=None, session=None):
+    """ Парсит товары пулом потоков, которые берут ссылки из общей очереди.
+
+    tasks — queue.Queue со ссылками; очередь может пополняться во время
+    работы, а None в ней останавливает один поток.
+    У каждого потока свой PageFetcher: страницы сначала запрашиваются
+    через общую HTTP-сессию, а браузер поднимается только при необходимости.
+    Результаты и ошибки сразу пишутся в журнал; возвращает число
+    распарсенных товаров.
+    """
+    if limiter is None:
+        limiter = RateLimiter(REQUESTS_PER_MINUTE, DOMAIN_RATE_LIMITS)
+    if session is None:
+        session = make_http_session(workers)
+
+    parsed = 0
+    parsed_lock = threading.Lock()
+    progress = tqdm(ncols=70, unit='товаров', colour='blue', file=sys.stdout)
+
+    def worker():
+        nonlocal parsed
+        fetcher = PageFetcher(session, limiter)
+        try:
+            while True:
+                url = tasks.get()
+                if url is None:
+                    return
+                headers = journal.conditional_headers(url) if journal.incremental else None
+                try:
+                    notebook = fetcher.fetch('product', url, parse_product_html,
+                                             'product-buy__price', journal.mark_fetched, headers)
+                except Exception as error:
+                    print(f'Не удалось распарсить {url}: {error}')
+                    journal.mark_failed(url, error)
+                else:
+                    if notebook is NOT_MODIFIED:
+                        journal.mark_unchanged(url)
+                    else:
+                        journal.save_product(url, notebook, fetcher.validators)
+                    with parsed_lock:
+                        parsed += 1
+                progress.update(1)
+        finally:
+            fetcher.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    progress.close()
+    journal.flush()
+
+    return parsed
+
+
+def _row_values(notebook):
+    """ Значения товара в порядке колонок; списки превращаются в строки."""
+    values = []
+    for name in COLUMN_NAMES:
+        value = notebook.get(name)
+        values.append(str(value) if isinstance(value, list) else value)
+    return values
+
+
+def _write_xlsx(data, path):
+    """ Пишет xlsx в режиме write-only: строки сразу уходят на диск."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
 
     side = Side(border_style='thin')
-    border = Border(
-        left=side,
-        right=side,
-        top=side,
-        bottom=side
-    )
-    alignment = Alignment(
-        horizontal='center',
-        vertical='center'
-    )
-
-    for column, name in enumerate(column_names, 1):
-        cell = sheet.cell(
-            column=column,
-            row=1,
-            value=name
-        )
-        cell.font = Font(bold=True)
-        cell.border = border
-        cell.alignment = alignment
-
-    counter = 1
-    for index, value in enumerate(data, 2):
-        for i in value.values():
-            cell = sheet.cell(
-                column=counter,
-                row=index,
-                value=str(i) if type(i) == list else i
-            )
-            cell.alignment = Alignment(horizontal='left')
-            counter += 1
-
-        counter = 1
+    workbook.add_named_style(NamedStyle(
+        name='header',
+        font=Font(bold=True),
+        border=Border(left=side, right=side, top=side, bottom=side),
+        alignment=Alignment(horizontal='center', vertical='center'),
+    ))
+    workbook.add_named_style(NamedStyle(
+        name='value',
+        alignment=Alignment(horizontal='left'),
+    ))
 
+    # В режиме write-only ширину колонок задают до записи строк
     for i in 'ABCDEFGHI':
         sheet.column_dimensions[i].width = 30
 
-    workbook.save(f"{file_name} {datetime.now().strftime('%d.%m.%y %H-%M-%S')}.xlsx")
+    header = []
+    for name in COLUMN_NAMES:
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.style = 'header'
+        header.append(cell)
+    sheet.append(header)
+
+    for notebook in data:
+        row = []
+        for value in _row_values(notebook):
+            cell = WriteOnlyCell(sheet, value=value)
+            cell.style = 'value'
+            row.append(cell)
+        sheet.append(row)
+
+    workbook.save(path)
+
+
+def _write_csv(data, path):
+    # utf-8-sig, чтобы Excel сам распознал кодировку
+    with open(path, 'w', newline='', encoding='utf-8-sig') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMN_NAMES)
+        for notebook in data:
+            writer.writerow(_row_values(notebook))
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    return pa.schema([
+        ("Категория", pa.string()),
+        ("Наименование", pa.string()),
+        ("Цена", pa.int64()),
+        ("Доступность", pa.string()),
+        ("Ссылка на товар", pa.string()),
+        ("Описание", pa.string()),
+        ("Главное изображение", pa.string()),
+        ("Лист с картинками", pa.list_(pa.string())),
+        ("Характеристики", pa.list_(pa.struct([
+            ("name", pa.string()),
+            ("value", pa.string()),
+        ]))),
+    ])
+
+
+def _parquet_record(notebook):
+    record = {name: notebook.get(name) for name in COLUMN_NAMES}
+    record["Характеристики"] = [
+        {"name": name, "value": value} for name, value in notebook["Характеристики"]
+    ]
+    return record
+
+
+def _write_parquet(data, path):
+    """ Пишет Parquet пачками по EXPORT_BATCH_SIZE товаров (одна пачка —
+    одна группа строк), характеристики сохраняются вложенным списком
+    пар name/value."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema()
+    data = iter(data)
+    with pq.ParquetWriter(path, schema) as writer:
+        while True:
+            batch = [_parquet_record(notebook) for notebook in islice(data, EXPORT_BATCH_SIZE)]
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+
+EXPORTERS = {
+    'xlsx': _write_xlsx,
+    'csv': _write_csv,
+    'parquet': _write_parquet,
+}
+
+
+class ProductStore:
+    """ Колоночное хранилище товаров в файле Parquet.
+
+    Файл читается через memory map, а фильтры по категории и цене
+    проверяются по статистике групп строк, поэтому запрос не загружает
+    в память всё хранилище.
+    """
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+
+    def write(self, products):
+        """ Перезаписывает хранилище товарами из итератора products."""
+        tmp_path = self.path + '.tmp'
+        _write_parquet(products, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def dataset(self):
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+
+        return ds.dataset(self.path, format='parquet',
+                          filesystem=fs.LocalFileSystem(use_mmap=True))
+
+    @staticmethod
+    def _filter(category=None, min_price=None, max_price=None):
+        import pyarrow.dataset as ds
+
+        expression = None
+        conditions = []
+        if category is not None:
+            conditions.append(ds.field("Категория") == category)
+        if min_price is not None:
+            conditions.append(ds.field("Цена") >= min_price)
+        if max_price is not None:
+            conditions.append(ds.field("Цена") <= max_price)
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def iter_batches(self, category=None, min_price=None, max_price=None, columns=None):
+        """ Отдаёт pyarrow.RecordBatch с товарами, подходящими под фильтры."""
+        scanner = self.dataset().scanner(
+            columns=columns,
+            filter=self._filter(category, min_price, max_price),
+            batch_size=EXPORT_BATCH_SIZE,
+        )
+        yield from scanner.to_batches()
+
+    def iter_products(self, category=None, min_price=None, max_price=None):
+        """ Отдаёт товары словарями в том же виде, что и парсер."""
+        for batch in self.iter_batches(category, min_price, max_price):
+            for notebook in batch.to_pylist():
+                notebook["Характеристики"] = [
+                    (pair["name"], pair["value"]) for pair in notebook["Характеристики"]
+                ]
+                yield notebook
+
+    def count(self, category=None, min_price=None, max_price=None):
+        return self.dataset().count_rows(filter=self._filter(category, min_price, max_price))
+
+
+def write_delta(journal, file_name="delta"):
+    """ Пишет изменения с прошлого запуска в JSON Lines: по строке на товар
+    с полем "Изменение" (new, changed) и по строке на пропавшую ссылку (removed)."""
+    path = f"{file_name} {datetime.now().strftime('%d.%m.%y %H-%M-%S')}.jsonl"
+    counts = {'new': 0, 'changed': 0, 'removed': 0}
+    with open(path, 'w', encoding='utf-8') as file:
+        for change, value in journal.iter_delta():
+            counts[change] += 1
+            if change == 'removed':
+                record = {"Изменение": change, "Ссылка на товар": value}
+            else:
+                record = {"Изменение": change, **value}
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    print(f"Новых товаров: {counts['new']}, изменилось: {counts['changed']}, "
+          f"пропало: {counts['removed']}")
+    return path
+
+
+def to_excel(data, file_name="table", fmt='xlsx'):
+    """ Экспортирует товары в xlsx, csv или parquet.
+
+    data — любой итерируемый объект со словарями товаров; он читается
+    один раз и целиком в памяти не держится.
+    """
+    print('=' * 20)
+    print(f'Начался экспорт в {fmt}')
+
+    path = f"{file_name} {datetime.now().strftime('%d.%m.%y %H-%M-%S')}.{fmt}"
+    EXPORTERS[fmt](data, path)
+    return path
 
 
 def main():
 
-    driver = uc.Chrome()
+    journal = CrawlJournal(JOURNAL_FILE)
+    session = make_http_session(WORKERS)
+    limiter = RateLimiter(REQUESTS_PER_MINUTE, DOMAIN_RATE_LIMITS)
     urls_to_parse = [
-        'https://www.dns-shop.ru/catalog/recipe/e585499db2f27251/demontaz/?p={page}',
-        'https://www.dns-shop.ru/catalog/17a89bb916404e77/platy-rasshireniya/?p={page}',
-        'https://www.dns-shop.ru/catalog/c8a984d0ba7f4e77/radiosistemy/?p={page}',
-        'https://www.dns-shop.ru/catalog/2c0f47131ade2231/aksessuary-dlya-materinskix-plat/?p={page}',
-        'https://www.dns-shop.ru/catalog/17a89b8416404e77/karty-videozaxvata/?p={page}',
+        DNS_BASE_URL + '/catalog/recipe/e585499db2f27251/demontaz/?p={page}',
+        DNS_BASE_URL + '/catalog/17a89bb916404e77/platy-rasshireniya/?p={page}',
+        DNS_BASE_URL + '/catalog/c8a984d0ba7f4e77/radiosistemy/?p={page}',
+        DNS_BASE_URL + '/catalog/2c0f47131ade2231/aksessuary-dlya-materinskix-plat/?p={page}',
+        DNS_BASE_URL + '/catalog/17a89b8416404e77/karty-videozaxvata/?p={page}',
     ]
 
-    urls = []
-    for index, url in enumerate(urls_to_parse):
-        print(f'Получение списка всех ссылок из {index+1} категории:')
-        parsed_url = get_all_category_page_urls(driver, url)
-        urls.append(parsed_url)
-
-    print("Запись всех ссылок в файл url.txt:")
-    with open('urls.txt', 'w') as file:
-        for url in urls:
-            for link in url:
-                file.write(link + "\n")
-
-    with open('urls.txt', 'r') as file:
-        urls = list(map(lambda line: line.strip(), file.readlines()))
-        print(urls)
-        info_dump = []
-        for url in tqdm(urls, ncols=70, unit='товаров',
-                        colour='blue', file=sys.stdout):
-            info_dump.append(parse_characteristics_page(driver, url))
-
-    with open('dump_list_pickle.txt', 'wb+') as file:
-        pickle.dump(info_dump, file)
-
-    with open('dump_list_pickle.txt', 'rb') as file:
-        info_dump = pickle.load(file)
-
-    to_excel(info_dump, file_name="info_dump")
+    # Сначала доделываем товары из журнала, новые ссылки из категорий
+    # попадают в ту же очередь по мере обхода
+    tasks = queue.Queue()
+    pending = journal.pending_urls()
+    print(f'В журнале {len(pending)} нераспарсенных товаров')
+    for url in pending:
+        tasks.put(url)
+
+    def discover():
+        try:
+            asyncio.run(discover_product_urls(urls_to_parse, journal, session, limiter, tasks))
+        finally:
+            for _ in range(WORKERS):
+                tasks.put(None)
+
+    producer = threading.Thread(target=discover, daemon=True)
+    producer.start()
+    crawl_pool(tasks, journal, workers=WORKERS, limiter=limiter, session=session)
+    producer.join()
+
+    store = ProductStore(STORE_FILE)
+    store.write(journal.iter_products())
+    for fmt in EXPORT_FORMATS:
+        to_excel(store.iter_products(), file_name="info_dump", fmt=fmt)
+    if journal.incremental:
+        write_delta(journal, file_name="info_delta")
+    journal.finish_run()
+    journal.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+"""Замер скорости и памяти бэкендов генерации описаний образов.
+
+Запуск:
+    python bench_llm.py --model Qwen/Qwen2.5-0.5B-Instruct --backends pipeline,transformers,int8
+    python bench_llm.py --backends gguf --gguf-model qwen2.5-0.5b-instruct-q4_k_m.gguf
+
+Каждый бэкенд запускается в отдельном процессе, чтобы замеры памяти не
+смешивались. Печатаются время загрузки, p50/p95 задержки одной пачки,
+число сгенерированных токенов в секунду и пиковая резидентная память
+процесса. «pipeline» — прежний способ генерации: transformers.pipeline в
+fp32, по одному промпту. Все бэкенды, включая его, генерируют не больше
+--max-new-tokens токенов, чтобы замеры были сопоставимы.
+"""
+import argparse
+import multiprocessing
+import resource
+from time import perf_counter
+
+from llm_backends import BACKEND_GGUF, make_backend
+
+PROMPT = ("Опиши стильный образ, подходящий для {occasion}. Он состоит из: {items}.  Учитывай стиль: {style}.  "
+          "Этот образ размера {size}, цвета {color}, и с составом ткани {composition}.  "
+          "Только оригинальные товары: Да.  Подходит для сезона: {season}.")
+
+OUTFITS = [
+    ("Прогулка в городе", "Джинсы прямые, Футболка хлопковая, Кеды белые", "Casual", "M", "Синий", "Хлопок", "Лето"),
+    ("Работа в офисе", "Брюки классические, Блузка шёлковая, Лоферы", "Классика", "S", "Бежевый", "Шёлк", "Весна"),
+    ("Свидание", "Платье миди, Туфли на каблуке, Клатч", "Романтичный", "XS", "Красный", "Вискоза", "Осень"),
+    ("Театр", "Пиджак бархатный, Юбка плиссе, Ботильоны", "Элегантный", "L", "Чёрный", "Полиэстер", "Зима"),
+]
+
+
+class PipelineBaseline:
+    """Прежняя генерация: transformers.pipeline в fp32, промпты по одному."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.generator = None
+
+    def load(self):
+        from transformers import pipeline
+
+        self.generator = pipeline("text-generation", model=self.model_name)
+
+    def generate_batch(self, prompts, sinks, max_new_tokens):
+        texts = []
+        for prompt in prompts:
+            # В боте было max_length=500 (вместе с промптом); для сравнения длина ответа та же, что у других бэкендов
+            result = self.generator(prompt, max_new_tokens=max_new_tokens, num_return_sequences=1, do_sample=True)
+            texts.append(result[0]["generated_text"][len(prompt):])
+        return texts
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.generator.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def make_prompts(count: int) -> list:
+    prompts = []
+    for i in range(count):
+        occasion, items, style, size, color, composition, season = OUTFITS[i % len(OUTFITS)]
+        prompts.append(PROMPT.format(occasion=occasion, items=items, style=style, size=size, color=color,
+                                     composition=composition, season=season))
+    return prompts
+
+
+def make_bench_backend(name: str, args):
+    if name == "pipeline":
+        return PipelineBaseline(args.model)
+    if name == BACKEND_GGUF:
+        return make_backend(name, args.gguf_model, n_threads=args.threads)
+    return make_backend(name, args.model, device_map=None, n_threads=args.threads)
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def peak_rss_mb() -> float:
+    # На Linux ru_maxrss — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(name: str, args, results):
+    """Выполняется в отдельном процессе: загружает бэкенд и гоняет по нему промпты."""
+    try:
+        backend = make_bench_backend(name, args)
+        started = perf_counter()
+        backend.load()
+        load_time = perf_counter() - started
+
+        prompts = make_prompts(args.requests)
+        backend.generate_batch(prompts[:1], [None], args.max_new_tokens)  # прогрев
+        for batch_size in args.batch_sizes:
+            latencies, tokens = [], 0
+            started = perf_counter()
+            for i in range(0, len(prompts), batch_size):
+                batch = prompts[i:i + batch_size]
+                batch_started = perf_counter()
+                texts = backend.generate_batch(batch, [None] * len(batch), args.max_new_tokens)
+                latencies.append(perf_counter() - batch_started)
+                tokens += sum(backend.count_tokens(text) for text in texts)
+            elapsed = perf_counter() - started
+            results.put({"name": name, "batch_size": batch_size, "load_time": load_time,
+                         "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+                         "tokens_per_second": tokens / elapsed, "rss": peak_rss_mb()})
+    except Exception as e:
+        results.put({"name": name, "error": repr(e)})
+
+
+def report(result: dict):
+    if "error" in result:
+        print(f"{result['name']:<14} ошибка: {result['error']}")
+        return
+    print(f"{result['name']:<14} пачка={result['batch_size']:<3} загрузка={result['load_time']:6.1f} с  "
+          f"p50={result['p50']:6.2f} с  p95={result['p95']:6.2f} с  "
+          f"{result['tokens_per_second']:7.1f} ток/с  RSS={result['rss']:7.0f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="pipeline,transformers,int8",
+                        help="через запятую: pipeline, transformers, int8, gguf")
+    parser.add_argument("--model", default="Qwen/Qwen2.5-0.5B-Instruct", help="модель transformers")
+    parser.add_argument("--gguf-model", help="путь к .gguf-файлу для бэкенда gguf")
+    parser.add_argument("--requests", type=int, default=8, help="промптов на каждый размер пачки")
+    parser.add_argument("--batch-sizes", default="1,4", help="размеры пачек через запятую")
+    parser.add_argument("--max-new-tokens", type=int, default=128, help="токенов в ответе")
+    parser.add_argument("--threads", type=int, default=None, help="потоков CPU для генерации")
+    args = parser.parse_args()
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+
+    context = multiprocessing.get_context("spawn")
+    for name in args.backends.split(","):
+        results = context.Queue()
+        process = context.Process(target=run_backend, args=(name, args, results))
+        process.start()
+        process.join()
+        while not results.empty():
+            report(results.get())
+
+
+if __name__ == "__main__":
+    main()
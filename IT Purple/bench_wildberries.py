@@ -0,0 +1,180 @@
+"""Нагрузочный замер клиента API Wildberries на локальном мок-сервере каталога.
+
+Запуск:
+    python bench_wildberries.py --requests 2000 --concurrency 100 --latency 0.02
+
+Сравнивает общий клиент с пулом соединений (WildberriesClient) и прежний
+способ, когда каждый запрос открывает новое соединение, и печатает
+p50/p95/p99 задержки и пропускную способность.
+
+Замер разбора ответа каталога:
+    python bench_wildberries.py --decode --payload page1.json page2.json
+
+Разбирает сохранённые ответы каталога (без --payload — сгенерированный
+ответ на --products товаров) прежним способом и через decode_catalog и
+печатает время разбора одного ответа и сколько блоков памяти и байт
+занимает результат.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import tracemalloc
+from time import perf_counter
+
+import aiohttp
+from aiohttp import web
+
+from catalog_query import JSON_BACKEND, ProductBatch, decode_catalog, json_loads
+from wildberries import WILDBERRIES_HEADERS, WildberriesClient
+
+
+def make_catalog_payload(products: int = 100) -> dict:
+    """Ответ каталога в формате API Wildberries со случайными товарами."""
+    return {
+        "data": {
+            "products": [
+                {
+                    "id": 10000000 + i,
+                    "name": f"Товар {i}",
+                    "brand": f"Бренд {i % 17}",
+                    "priceU": random.randint(500, 20000) * 100,
+                    "salePriceU": random.randint(500, 20000) * 100,
+                    "image": f"https://images.wbstatic.net/{i}.jpg",
+                    "rating": random.randint(0, 5),
+                    "feedbacks": random.randint(0, 5000),
+                    "sizes": [{"name": size, "origName": size, "optionId": random.randint(1, 10 ** 9)}
+                              for size in random.sample(["42", "44", "46", "48", "50", "52"], 3)],
+                    "colors": [{"name": random.choice(["черный", "белый", "синий"]), "id": 0}],
+                    # Поля, которые бот не использует, но которые есть в ответе каталога
+                    "root": 20000000 + i,
+                    "subjectId": 8126,
+                    "supplierId": random.randint(1, 10 ** 6),
+                    "pics": random.randint(1, 15),
+                    "volume": random.randint(1, 50),
+                    "promotions": [random.randint(1, 10 ** 5) for _ in range(3)],
+                    "log": {"cpm": 150, "promotion": 1, "promoPosition": i, "position": i},
+                }
+                for i in range(products)
+            ]
+        }
+    }
+
+
+async def start_mock_server(latency: float, products: int):
+    """Поднимает мок каталога на свободном порту и возвращает (runner, url)."""
+    payload = make_catalog_payload(products)
+
+    async def catalog(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        return web.json_response(payload)
+
+    app = web.Application()
+    app.router.add_get("/catalog", catalog)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/catalog"
+
+
+async def run_load(request_once, total: int, concurrency: int) -> tuple:
+    """Выполняет total запросов не более чем concurrency одновременно."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            started = perf_counter()
+            await request_once({"cat": str(8126 + i % 16), "appType": "1", "curr": "rub"})
+            latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return latencies, perf_counter() - started
+
+
+def report(name: str, latencies: list, elapsed: float):
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:<28} p50={quantiles[49] * 1000:7.1f} мс  p95={quantiles[94] * 1000:7.1f} мс  "
+          f"p99={quantiles[98] * 1000:7.1f} мс  {len(latencies) / elapsed:8.1f} запр/с")
+
+
+async def bench_latency(args):
+    runner, url = await start_mock_server(args.latency, args.products)
+    try:
+        client = WildberriesClient(base_url=url, connections_per_host=args.concurrency)
+        latencies, elapsed = await run_load(client.get_catalog, args.requests, args.concurrency)
+        await client.close()
+        report("Общий пул соединений", latencies, elapsed)
+
+        async def fresh_connection(params):
+            async with aiohttp.ClientSession(headers=WILDBERRIES_HEADERS,
+                                             connector=aiohttp.TCPConnector(force_close=True)) as session:
+                async with session.get(url, params=params) as response:
+                    return await response.json()
+
+        latencies, elapsed = await run_load(fresh_connection, args.requests, args.concurrency)
+        report("Новое соединение на запрос", latencies, elapsed)
+    finally:
+        await runner.cleanup()
+
+
+def measure_decode(decode, body: bytes, repeats: int) -> tuple:
+    """Медианное время decode(body) и память результата: (секунды, блоки, байты)."""
+    timings = []
+    for _ in range(repeats):
+        started = perf_counter()
+        decode(body)
+        timings.append(perf_counter() - started)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = decode(body)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    del result
+    return (statistics.median(timings), sum(stat.count_diff for stat in stats),
+            sum(stat.size_diff for stat in stats))
+
+
+def bench_decode(args):
+    bodies = []
+    for filename in args.payload:
+        with open(filename, "rb") as payload_file:
+            bodies.append(payload_file.read())
+    if not bodies:
+        bodies.append(json.dumps(make_catalog_payload(args.products), ensure_ascii=False).encode("utf-8"))
+
+    decoders = [("json.loads (прежний)", json.loads)]
+    if JSON_BACKEND == "msgspec":
+        decoders.append((f"{json_loads.__module__}.loads -> ProductBatch",
+                         lambda body: ProductBatch.from_products(json_loads(body)["data"]["products"])))
+    decoders.append((f"decode_catalog ({JSON_BACKEND})", decode_catalog))
+    for body in bodies:
+        print(f"Ответ {len(body) / 1024:.0f} КБ, {len(decode_catalog(body))} товаров")
+        for name, decode in decoders:
+            elapsed, blocks, size = measure_decode(decode, body, args.repeats)
+            print(f"  {name:<36} {elapsed * 1000:7.2f} мс  {blocks:7d} блоков  {size / 1024:8.1f} КБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="всего запросов")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных запросов")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа мок-сервера, с")
+    parser.add_argument("--products", type=int, default=100, help="товаров в ответе")
+    parser.add_argument("--decode", action="store_true", help="замерить разбор ответа вместо запросов")
+    parser.add_argument("--payload", nargs="*", default=[], help="сохранённые ответы каталога (JSON)")
+    parser.add_argument("--repeats", type=int, default=200, help="повторов разбора каждого ответа")
+    args = parser.parse_args()
+    if args.decode:
+        bench_decode(args)
+    else:
+        asyncio.run(bench_latency(args))
+
+
+if __name__ == "__main__":
+    main()
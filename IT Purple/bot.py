@@ -1,116 +1,132 @@
 import os
 import logging
 import pymongo
-import requests
-from telebot import TeleBot, types
-from transformers import pipeline
-from time import time
-from typing import List, Dict, Any
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from clothing_cache import CacheWriter, ensure_item_indexes, find_cached_items
+from wildberries import MongoQueryCacheTier, QueryCache, WildberriesAPIError, WildberriesClient
+from llm_backends import make_backend
+from llm_worker import InferenceWorker
+from description_cache import DescriptionCache
+from category_index import CategoryIndex, normalize
+from session_store import SESSION_BACKEND_MONGO, MemorySessionStore, MongoSessionStore, new_session
+from dialog import DialogMachine, InvalidInput, Message, Step, fixed_prompt
+from catalog_query import ProductBatch, build_catalog_query, decode_catalog, select_products
+from outfit_render import deliver_progressively, rank_items, render_description, render_items
+from keyboards import FORCE_REPLY, FORCE_REPLY_SELECTIVE, KeyboardRegistry, inline_keyboard
+from typing import AsyncIterator, List, Dict, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import functools
 
 # 1. Настройка
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
-if not TELEGRAM_TOKEN:
-    raise ValueError("Telegram token not found in environment variables.")
 
 MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/")
 DB_NAME = "shopping_assistant"
 CLOTHING_COLLECTION = "clothing_items"
 USER_COLLECTION = "users"
+QUERY_CACHE_COLLECTION = "query_cache"
+# Общий для всех процессов бота уровень кэша запросов к каталогу в MongoDB
+QUERY_CACHE_SHARED = os.environ.get("QUERY_CACHE_SHARED", "0") == "1"
+DESCRIPTION_COLLECTION = "outfit_descriptions"
+# Порог сходства названий товаров, при котором берётся описание похожего образа
+# (None — только точное совпадение)
+DESCRIPTION_NEAR_DUPLICATE = 0.8
+SESSION_COLLECTION = "sessions"
+# Где хранятся сессии диалога: memory (в процессе) или mongo (общие для всех процессов бота)
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
 
-WILDBERRIES_API_URL = "https://catalog.wb.ru/catalog/electronic14/v2/catalog"
 WILDBERRIES_API_TOKEN = os.environ.get("WILDBERRIES_API_TOKEN", "WILDBERRIES_API_TOKEN")
 
-MODEL_NAME = "meta-llama/Llama-2-7b-chat-hf"
+# Бэкенд генерации описаний: transformers (fp32), int8 (динамическое int8-квантование
+# на CPU) или gguf (4-битная модель в llama.cpp, LLM_MODEL — путь к .gguf-файлу).
+# Для CPU-узлов подходит небольшая instruct-модель, например
+# LLM_BACKEND=int8 LLM_MODEL=Qwen/Qwen2.5-1.5B-Instruct
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "transformers")
+MODEL_NAME = os.environ.get("LLM_MODEL", "meta-llama/Llama-2-7b-chat-hf")
+LLM_MAX_NEW_TOKENS = int(os.environ.get("LLM_MAX_NEW_TOKENS", "200"))
 
-bot = TeleBot(TELEGRAM_TOKEN)
+# Прокси для запросов к API Wildberries (пустая строка — без прокси)
+PROXY_URL = os.environ.get("PROXY_URL", "http://proxy:8080")
+
+# Число потоков, в которых идёт генерация LLM
+LLM_WORKERS = 1
+
+# Токен проверяется в main(), чтобы модуль можно было импортировать без него
+bot = AsyncTeleBot(TELEGRAM_TOKEN or "", validate_token=False)
 
 # 2. Инициализация LLM
-generator = pipeline("text-generation", model=MODEL_NAME, device_map="auto")
+# Модель загружается в потоке llm_executor при первом запросе или в warm_up()
+llm_backend = make_backend(LLM_BACKEND, MODEL_NAME)
+llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+# Промпты из разных чатов генерируются пачками в llm_executor
+llm_worker = InferenceWorker(llm_backend, llm_executor, max_new_tokens=LLM_MAX_NEW_TOKENS)
 
 # 3. Инициализация MongoDB
-client = pymongo.MongoClient(MONGODB_URI)
+# connect=False: соединение откроется при первом запросе, а не при импорте
+client = pymongo.MongoClient(MONGODB_URI, connect=False)
 db = client[DB_NAME]
 clothing_items_collection = db[CLOTHING_COLLECTION]
 users_collection = db[USER_COLLECTION]
+# Запись ответов API в кэш идёт в фоне, вне обработки запроса пользователя
+cache_writer = CacheWriter(clothing_items_collection)
+# Готовые описания образов, чтобы не генерировать их повторно
+description_cache = DescriptionCache(db[DESCRIPTION_COLLECTION], near_duplicate_threshold=DESCRIPTION_NEAR_DUPLICATE)
+# Сессии диалога пользователей
+sessions = MongoSessionStore(db[SESSION_COLLECTION]) if SESSION_BACKEND == SESSION_BACKEND_MONGO \
+    else MemorySessionStore()
+# Если в кэше нашлось не меньше CACHE_MIN_ITEMS подходящих товаров, API не запрашивается
+CACHE_MIN_ITEMS = 5
+
+# Общий клиент API Wildberries с пулом соединений и кэшем запросов
+# Кэш запросов хранит страницы каталога как ProductBatch, в MongoDB — по столбцам
+shared_query_cache = MongoQueryCacheTier(db[QUERY_CACHE_COLLECTION], encode=ProductBatch.to_document,
+                                         decode=ProductBatch.from_document)
+query_cache = QueryCache(shared=shared_query_cache if QUERY_CACHE_SHARED else None)
+wildberries_client = WildberriesClient(proxy=PROXY_URL, cache=query_cache, decode=decode_catalog)
 
 # 4. Логирование
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # 5. Состояния диалога
-user_states: Dict[int, Dict[str, Any]] = {}
 STATE_START = "start"
 STATE_OCCASION = "occasion"
 STATE_STYLE_PREFERENCES = "style_preferences"
+STATE_CATEGORY = "category"
 STATE_BUDGET = "budget"
 STATE_SHOW_OUTFIT = "show_outfit"
 STATE_BODY_TYPE = "body_type"
 STATE_AGE_GROUP = "age_group"
 
-proxies = {
-    'http': 'http://proxy:8080',
-    'https': 'https://proxy:8080',
-}
-
 categories_by_situation = {
         "Прогулка": ["Джинсы", "Футболки", "Кеды", "Куртки"],
         "Работа": ["Блузки", "Брюки", "Юбки", "Пиджаки"],
         "Свидание": ["Платья", "Туфли", "Аксессуары"]
 }
 
+# Категории каталога для шага выбора категории; меню перечитывается только при изменении файла
+CATEGORIES_FILE = "wildberries_menu.csv"
+category_index = CategoryIndex(CATEGORIES_FILE)
+
 # 6. Функции для работы с API Wildberries
 async def get_clothing_items_from_api(occasion: str, category: str, style_preferences: List[str], budget: int, body_type: str, age_group: str) -> List[Dict[str, Any]]:
-    """Получает готовые образы с API Wildberries."""
-    query_params = {
-        'appType': '1',
-        'curr': 'rub',
-        'dest': '-1185367',
-        'sort': 'popular',
-        'spp': '30',
-        'cat': category
-    }
+    """Получает готовые образы с API Wildberries.
+
+    Бюджет уходит фильтром priceU в запрос к каталогу, а select_products
+    ещё раз проверяет цену и ранжирует товары.
+    """
+    query_params = build_catalog_query(category, budget=budget)
 
     if style_preferences:
         query_params["subject"] = ",".join(style_preferences)
 
-    headers = {
-        'Accept': '*/*',
-        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Origin': 'https://www.wildberries.ru',
-        'Referer': 'https://www.wildberries.ru',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'cross-site',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',
-        'sec-ch-ua': '"Not)A;Brand";v="99", "Google Chrome";v="127", "Chromium";v="127"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-    }
-
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, requests.get, WILDBERRIES_API_URL, headers=headers, params=query_params, proxies=proxies)
-        response.raise_for_status()
-        data = response.json()
-
-        # Адаптация структуры данных API Wildberries
-        clothing_items = []
-        for item in data["data"]["products"]:
-            clothing_items.append({
-                "_id": item["id"],
-                "name": item["name"],
-                "description": item["brand"],
-                "price": item["priceU"] / 100,
-                "image_url": item["image"],
-                "marketplace_url": f"https://www.wildberries.ru/catalog/{item['id']}/detail.aspx",
-                "items": [],
-                "last_updated": time()
-            })
-        return clothing_items
-
-    except requests.exceptions.RequestException as e:
+        products = await wildberries_client.get_catalog(query_params)
+        return select_products(products, budget=budget).to_items(category)
+
+    except WildberriesAPIError as e:
         logging.error(f"Ошибка при запросе к API Wildberries: {e}")
         return []
     except Exception as e:
@@ -118,312 +134,269 @@ async def get_clothing_items_from_api(occasion: str, category: str, style_prefer
         return []
 
 # 7. Функции для работы с базой данных (MongoDB)
-def cache_clothing_items(clothing_items: List[Dict[str, Any]]):
-    """Кэширует образы в MongoDB."""
-    for item in clothing_items:
-        existing_item = clothing_items_collection.find_one({"_id": item["_id"]})
-
-        if existing_item:
-            clothing_items_collection.update_one({"_id": item["_id"]}, {"$set": item})
-            logging.info(f"Обновлен образ {item['name']} в кэше.")
-        else:
-            clothing_items_collection.insert_one(item)
-            logging.info(f"Добавлен образ {item['name']} в кэш.")
-
-def get_cached_clothing_items(occasion: str, style_preferences: List[str], budget: int, body_type: str, age_group: str) -> List[Dict[str, Any]]:
-    """Получает закэшированные образы из MongoDB (TODO: добавить фильтрацию)."""
-    return list(clothing_items_collection.find({}))
+def get_cached_clothing_items(category_id: str, budget: int = None) -> List[Dict[str, Any]]:
+    """Получает из MongoDB свежие закэшированные образы категории в пределах бюджета."""
+    return find_cached_items(clothing_items_collection, category_id, budget)
 
 # 8. Функции для работы с LLM
-def generate_outfit_description(clothing_items: List[Dict[str, Any]], occasion: str, style_preferences: List[str], body_type: str, age_group: str) -> str:
-    """Генерирует описание образа с использованием LLM, учитывая тип фигуры и возраст."""
-    items_str = ", ".join([item['name'] for item in clothing_items])
+async def generate_outfit_description(clothing_items: List[Dict[str, Any]], occasion: str, style_preferences: List[str], body_type: str, age_group: str) -> AsyncIterator[str]:
+    """Генерирует описание образа с использованием LLM, учитывая тип фигуры и возраст.
+
+    Описание отдаётся кусками по мере генерации; из кэша — целиком одним куском.
+    """
+    item_names = [item['name'] for item in clothing_items]
+    items_str = ", ".join(item_names)
     prompt = f"Опиши образ '{items_str}', подходящий для {occasion}. Учитывай, что предпочитаемый стиль: {', '.join(style_preferences)}. Также учти, что тип фигуры: {body_type}, возраст: {age_group}. Объясни, почему этот образ подходит для этого типа фигуры и возраста, и дай советы по аксессуарам. "
 
+    choices = {"occasion": occasion, "style_preferences": style_preferences,
+               "body_type": body_type, "age_group": age_group}
+    try:
+        description = await asyncio.to_thread(description_cache.lookup, item_names, choices)
+    except Exception:
+        logging.exception("Не удалось прочитать кэш описаний")
+        description = None
+    if description is not None:
+        yield description
+        return
+
     logging.info(f"Prompting LLM: {prompt}")
+    parts = []
     try:
-        result = generator(prompt, max_length=500, num_return_sequences=1, do_sample=True)
-        description = result[0]['generated_text']
+        async for chunk in llm_worker.stream(prompt):
+            parts.append(chunk)
+            yield chunk
     except Exception as e:
         logging.error(f"Error generating description: {e}")
-        description = "Не удалось сгенерировать описание для этого образа."
-    return description
-
-def format_outfit_result(clothing_items: List[Dict[str, Any]], description: str) -> str:
-    """Форматирует результат для отправки пользователю."""
-    message = "<b>Рекомендуемый образ:</b>\n\n"
-    for item in clothing_items:
-        message += f"- <a href='{item['marketplace_url']}'>{item['name']}</a>\n"
-        message += f"Описание: {item['description']}\n"
-        message += f"Состав: {item['items']}\n\n"
-    message += f"\n<b>Описание от AI:</b>\n{description}"
-    return message
-
-def send_outfit_result(chat_id: int, outfit: str):
-    """Отправляет результат пользователю."""
-    bot.send_message(chat_id, outfit, parse_mode="HTML", disable_web_page_preview=True)
-
-# 9. Функции управления интерфейсом
-def set_occasion_buttons(chat_id: int):
-    """Предлагает выбор ситуации (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    occasions = ["Прогулка", "Работа", "Свидание", "Встреча с друзьями", "Особый случай", "Любая"]
-    for occasion in occasions:
-        item = types.InlineKeyboardButton(occasion, callback_data=f"occasion:{occasion}")
-        markup.add(item)
-
-    # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другое")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-
-    user_states[chat_id] = {"history": [], "data": {}}  # Инициализация
-    user_states[chat_id]["history"].append({"state": STATE_OCCASION, "data": {}})
-
-def set_style_preferences_options(chat_id: int):
-    """Запрашивает стилевые предпочтения (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    styles = ["Классический", "Повседневный", "Элегантный", "Спортивный", "Бохо", "Минимализм"]
-    for style in styles:
-        item = types.InlineKeyboardButton(style, callback_data=f"style:{style}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="style:back")
-    markup.add(back_button)
-
-    # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другое")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-
-    bot.send_message(chat_id, "Какие стили вы предпочитаете?", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_STYLE_PREFERENCES, "data": {}})
-
-def set_budget_options(chat_id: int):
-    """Запрашивает бюджет (ForceReply)."""
-    markup = types.ForceReply(selective=False)
-    bot.send_message(chat_id, "Какой у вас бюджет на этот образ (в рублях)?", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_BUDGET, "data": {}})
-
-def set_body_type_options(chat_id: int):
-    """Предлагает пользователю выбрать тип фигуры (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    body_types = ["Песочные часы", "Прямоугольник", "Яблоко", "Груша"]
-    for body_type in body_types:
-        item = types.InlineKeyboardButton(body_type, callback_data=f"body_type:{body_type}")
-        markup.add(item)
-
-    # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другое")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-    bot.send_message(chat_id, "Какой у вас тип фигуры?", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-
-    user_states[chat_id]["history"].append({"state": STATE_BODY_TYPE, "data": {}})
-
-def set_age_group_options(chat_id: int):
-    """Предлагает пользователю выбрать возрастную группу(InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    age_groups = ["18-25", "26-35", "36-45", "46+"]
-    for age_group in age_groups:
-        item = types.InlineKeyboardButton(age_group, callback_data=f"age_group:{age_group}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="age_group:back")
-    markup.add(back_button)
-
-    # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другое")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-
-    bot.send_message(chat_id, "К какой возрастной группе вы относитесь?", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_AGE_GROUP, "data": {}})
-
-# 10. Проверка состояния пользователя
-def check_occasion_state(message: types.Message) -> bool:
-    """Проверяет, находится ли пользователь в состоянии выбора ситуации."""
-    chat_id = message.chat.id
-    if not user_states.get(chat_id) or not user_states[chat_id].get("history"):
-        return False
-    return user_states[chat_id]["history"][-1]["state"] == STATE_OCCASION
+        if not parts:
+            yield "Не удалось сгенерировать описание для этого образа."
+        return
+
+    try:
+        await asyncio.to_thread(description_cache.store, item_names, choices, "".join(parts))
+    except Exception:
+        logging.exception("Не удалось сохранить описание в кэш")
+
+async def send_outfit_result(chat_id: int, clothing_items: List[Dict[str, Any]], description: AsyncIterator[str]):
+    """Отправляет список товаров сразу, а описание от AI — следом, дописывая его по мере генерации."""
+    await bot.send_message(chat_id, render_items(clothing_items), parse_mode="HTML", disable_web_page_preview=True)
+
+    async def send(text: str) -> types.Message:
+        return await bot.send_message(chat_id, render_description(text), parse_mode="HTML")
+
+    async def edit(message: types.Message, text: str):
+        try:
+            await bot.edit_message_text(render_description(text), chat_id=chat_id, message_id=message.message_id,
+                                        parse_mode="HTML")
+        except ApiTelegramException as e:
+            # Пропущенное промежуточное обновление не страшно: следующее покажет весь текст
+            logging.warning(f"Не удалось обновить описание в чате {chat_id}: {e}")
+
+    await deliver_progressively(description, send, edit)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def run_in_background(coro):
+    """Запускает корутину фоновой задачей, не задерживая обработку обновлений."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def build_and_send_outfit(chat_id: int, params: Dict[str, Any]):
+    """Подбирает образ и отправляет его пользователю.
+
+    Сначала товары ищутся в кэше MongoDB, к API идёт запрос, только если
+    подходящих свежих товаров там мало. Запросы к API ограничены пулом
+    соединений wildberries_client, описание генерируется пачками в
+    llm_worker, а запись в MongoDB идёт в фоне через cache_writer, поэтому
+    цикл событий бота не блокируется. Пользователь сразу получает лучшие
+    товары в пределах бюджета, а описание дописывается по мере генерации.
+    """
+    try:
+        clothing_items = await asyncio.to_thread(get_cached_clothing_items, params["category"], params["budget"])
+        if len(clothing_items) < CACHE_MIN_ITEMS:
+            clothing_items = await get_clothing_items_from_api(
+                params["occasion"], params["category"], params["style_preferences"], params["budget"],
+                params["body_type"], params["age_group"])
+            cache_writer.submit(clothing_items)
+
+        clothing_items = rank_items(clothing_items, params["budget"])
+        if not clothing_items:
+            await bot.send_message(chat_id, "Не нашлось товаров в пределах бюджета. Попробуйте изменить параметры.")
+            return
+
+        outfit_description = generate_outfit_description(
+            clothing_items, params["occasion"], params["style_preferences"], params["body_type"],
+            params["age_group"])
+        await send_outfit_result(chat_id, clothing_items, outfit_description)
+    except Exception:
+        logging.exception(f"Ошибка при подборе образа для {chat_id}")
+        await bot.send_message(chat_id, "Не удалось подобрать образ. Попробуйте позже.")
+
+# 9. Шаги диалога
+OCCASIONS = ["Прогулка", "Работа", "Свидание", "Встреча с друзьями", "Особый случай", "Любая"]
+STYLES = ["Классический", "Повседневный", "Элегантный", "Спортивный", "Бохо", "Минимализм"]
+BODY_TYPES = ["Песочные часы", "Прямоугольник", "Яблоко", "Груша"]
+AGE_GROUPS = ["18-25", "26-35", "36-45", "46+"]
+
+# Клавиатуры шагов строятся и сериализуются один раз при запуске
+keyboards = KeyboardRegistry()
+keyboards.add(STATE_OCCASION, inline_keyboard(STATE_OCCASION, OCCASIONS, other="Другое", back=False))
+keyboards.add(STATE_STYLE_PREFERENCES, inline_keyboard(STATE_STYLE_PREFERENCES, STYLES, other="Другое"))
+keyboards.add(STATE_BODY_TYPE, inline_keyboard(STATE_BODY_TYPE, BODY_TYPES, other="Другое"))
+keyboards.add(STATE_AGE_GROUP, inline_keyboard(STATE_AGE_GROUP, AGE_GROUPS, other="Другое"))
+
+def category_keyboard(style: str) -> str:
+    # Для своего варианта стиля в меню может не найтись категорий — тогда предлагается всё меню
+    categories = category_index.find(style=style) or category_index.find()
+    return inline_keyboard(STATE_CATEGORY, [(category["name"], category["id"]) for category in categories])
+
+def category_prompt(data: Dict[str, Any]) -> Message:
+    """Выбор категории каталога, подходящей для выбранного стиля (InlineKeyboard)."""
+    style = (data.get("style_preferences") or [""])[0]
+    # Клавиатура категорий кэшируется по стилю до изменения файла меню
+    markup = keyboards.dynamic(normalize(style), lambda: category_keyboard(style),
+                               version=category_index.version())
+    return "Выберите категорию одежды:", markup
+
+def parse_style_preferences(text: str, data: Dict[str, Any]) -> List[str]:
+    return [text]
+
+def parse_budget(text: str, data: Dict[str, Any]) -> int:
+    try:
+        budget = int(text)
+    except ValueError:
+        raise InvalidInput("Пожалуйста, введите бюджет числом.")
+    if budget <= 0:
+        raise InvalidInput("Бюджет должен быть больше нуля.")
+    return budget
+
+def other_option(prompt_text: str) -> Tuple[str, Message]:
+    """Кнопка «Другое»: просит ввести свой вариант ответа."""
+    return "Другое", (prompt_text, FORCE_REPLY_SELECTIVE)
+
+# Диалог целиком: шаг -> вопрос, разбор ответа и следующий шаг
+DIALOG_STEPS = [
+    Step(STATE_OCCASION, fixed_prompt("Для какой ситуации вы подбираете образ?", keyboards[STATE_OCCASION]),
+         STATE_STYLE_PREFERENCES, other=other_option("Пожалуйста, введите свой вариант ситуации:")),
+    Step(STATE_STYLE_PREFERENCES, fixed_prompt("Какие стили вы предпочитаете?", keyboards[STATE_STYLE_PREFERENCES]),
+         STATE_CATEGORY, parse=parse_style_preferences,
+         other=other_option("Пожалуйста, введите свой вариант стиля:")),
+    Step(STATE_CATEGORY, category_prompt, STATE_BODY_TYPE, text_input=False),
+    Step(STATE_BODY_TYPE, fixed_prompt("Какой у вас тип фигуры?", keyboards[STATE_BODY_TYPE]),
+         STATE_AGE_GROUP, other=other_option("Пожалуйста, введите свой вариант типа фигуры:")),
+    Step(STATE_AGE_GROUP, fixed_prompt("К какой возрастной группе вы относитесь?", keyboards[STATE_AGE_GROUP]),
+         STATE_BUDGET, other=other_option("Пожалуйста, введите свой вариант возрастной группы:")),
+    Step(STATE_BUDGET, fixed_prompt("Какой у вас бюджет на этот образ (в рублях)?", FORCE_REPLY),
+         None, parse=parse_budget),
+]
+
+async def send_dialog_message(chat_id: int, text: str, markup: Any):
+    await bot.send_message(chat_id, text, reply_markup=markup)
+
+async def start_outfit_search(chat_id: int, data: Dict[str, Any]):
+    """Завершение диалога: запускает подбор образа по собранным ответам."""
+    params = {
+        "occasion": data.get("occasion"),
+        "category": data.get("category"),
+        "style_preferences": data.get("style_preferences", []),
+        "budget": data.get("budget"),
+        "body_type": data.get("body_type"),
+        "age_group": data.get("age_group"),
+    }
+    await bot.send_message(chat_id, "Подбираю образ, это займёт немного времени...")
+    # Запрос к API и генерация описания идут в фоне
+    run_in_background(build_and_send_outfit(chat_id, params))
+
+dialog = DialogMachine(DIALOG_STEPS, send_dialog_message, start_outfit_search)
+
+# 10. Сессии пользователей
+def with_session(handler):
+    """Загружает сессию чата перед обработчиком и сохраняет её после него.
+
+    Без сессии кнопка значит, что сессия устарела, а текст — что диалог
+    ещё не начат; в обоих случаях пользователь получает подсказку про /start.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update):
+        message = update.message if isinstance(update, types.CallbackQuery) else update
+        chat_id = message.chat.id
+        session = await sessions.get(chat_id)
+        if session is None:
+            if isinstance(update, types.CallbackQuery):
+                await bot.answer_callback_query(update.id)
+                await bot.send_message(chat_id, "Сессия устарела. Отправьте /start, чтобы начать заново.")
+            else:
+                await bot.send_message(chat_id, "Чтобы подобрать образ, отправьте /start.")
+            return
+        await handler(update, session)
+        await sessions.save(chat_id, session)
+    return wrapper
 
 # 11. Обработчики сообщений и callback-запросов
 @bot.message_handler(commands=['start'])
-def handle_start(message: types.Message):
+async def handle_start(message: types.Message):
     """Обработчик команды /start."""
     chat_id = message.chat.id
     logging.info(f"Handling /start command for chat_id: {chat_id}")
     # Добавляем приветственное сообщение
-    bot.send_message(chat_id, "Привет! Я помогу тебе подобрать стильный образ. Давай начнем!")
-    set_occasion_buttons(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("occasion"))
-def handle_occasion_inline(call: types.CallbackQuery):
-    """Обработчик выбора ситуации (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    occasion = call.data.split(":")[1]
-    user_states[chat_id]["data"]["occasion"] = occasion
-    set_style_preferences_options(chat_id)
-    bot.answer_callback_query(call.id)
-    logging.info(f"User {chat_id} selected occasion: {occasion}")
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_OCCASION)
-def handle_occasion(message: types.Message):
-    """Обработчик ввода с клавиатуры (Другое или Назад)."""
-    chat_id = message.chat.id
-    occasion_text = message.text
-    if occasion_text == "Другое":
-        bot.send_message(chat_id, "Пожалуйста, введите свой вариант ситуации:",
-                         reply_markup=types.ForceReply(selective=True))
-    elif occasion_text == "Назад":
-        handle_back(chat_id)
-    else:
-        user_states[chat_id]["data"]["occasion"] = occasion_text
-        set_style_preferences_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("style"))
-def handle_style_preferences_inline(call: types.CallbackQuery):
-    """Обработчик выбора категории одежды (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    category = call.data.split(":")[1]
-    if call.data == "style:back":
-      handle_back(chat_id)
-      return
-    user_states[chat_id]["data"]["category"] = category
-    set_body_type_options(chat_id)
-    bot.answer_callback_query(call.id)
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_STYLE_PREFERENCES)
-def handle_style_preferences(message: types.Message):
-    """Обработчик ввода с клавиатуры (Другое или Назад)."""
-    chat_id = message.chat.id
-    style_text = message.text
-    if style_text == "Другое":
-        bot.send_message(chat_id, "Пожалуйста, введите свой вариант стиля:",
-                         reply_markup=types.ForceReply(selective=True))
-    elif style_text == "Назад":
-        handle_back(chat_id)
-    else:
-        user_states[chat_id]["data"]["style_preferences"] = [style_text]
-        set_budget_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("age_group"))
-def handle_age_group_inline(call: types.CallbackQuery):
-    """Обработчик выбора возрастной группы (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    age_group = call.data.split(":")[1]
-    if age_group == "back":
-        handle_back(chat_id)
-        return
-    user_states[chat_id]["data"]["age_group"] = age_group
-    set_style_preferences_options(chat_id)
-    bot.answer_callback_query(call.id)
+    await bot.send_message(chat_id, "Привет! Я помогу тебе подобрать стильный образ. Давай начнем!")
+    session = new_session()
+    await dialog.start(chat_id, session)
+    await sessions.save(chat_id, session)
+
+@bot.message_handler(func=lambda message: message.text.startswith("/"))
+async def handle_unknown_command(message: types.Message):
+    """Другие команды не обрабатываются и не считаются ответом на шаг диалога."""
+    logging.info(f"Ignoring unknown command {message.text.split()[0]!r} from chat_id: {message.chat.id}")
+
+@bot.callback_query_handler(func=lambda call: True)
+@with_session
+async def handle_choice(call: types.CallbackQuery, session: Dict[str, Any]):
+    """Нажатие инлайн-кнопки; callback_data имеет вид «состояние:значение»."""
+    await bot.answer_callback_query(call.id)
+    state, _, value = call.data.partition(":")
+    await dialog.handle_choice(call.message.chat.id, session, state, value)
+
+@bot.message_handler(content_types=['text'])
+@with_session
+async def handle_text(message: types.Message, session: Dict[str, Any]):
+    """Текстовый ответ на текущий шаг диалога."""
+    await dialog.handle_text(message.chat.id, session, message.text)
 
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_AGE_GROUP)
-def handle_age_group(message: types.Message):
-    """Обработчик ввода с клавиатуры (Другое или Назад)."""
-    chat_id = message.chat.id
-    age_group_text = message.text
-    if age_group_text == "Другое":
-        bot.send_message(chat_id, "Пожалуйста, введите свой вариант возрастной группы:",
-                         reply_markup=types.ForceReply(selective=True))
-    elif age_group_text == "Назад":
-        handle_back(chat_id)
-    else:
-        user_states[chat_id]["data"]["age_group"] = age_group_text
-        set_style_preferences_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("body_type"))
-def handle_body_type_inline(call: types.CallbackQuery):
-    """Обработчик выбора типа фигуры (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    body_type = call.data.split(":")[1]
-    if body_type == "back":
-        handle_back(chat_id)
-        return
-    user_states[chat_id]["data"]["body_type"] = body_type
-    set_age_group_options(chat_id)
-    bot.answer_callback_query(call.id)
+# 12. Запуск бота
+async def warm_up():
+    """Готовит бота к работе в фоне: создаёт индексы MongoDB и загружает модель.
 
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_BODY_TYPE)
-def handle_body_type(message: types.Message):
-    """Обработчик ввода с клавиатуры (Другое или Назад)."""
-    chat_id = message.chat.id
-    body_type_text = message.text
-    if body_type_text == "Другое":
-        bot.send_message(chat_id, "Пожалуйста, введите свой вариант типа фигуры:",
-                         reply_markup=types.ForceReply(selective=True))
-    elif body_type_text == "Назад":
-        handle_back(chat_id)
+    Бот принимает обновления сразу после запуска, запросы до окончания
+    загрузки модели просто дождутся её.
+    """
+    try:
+        await asyncio.to_thread(ensure_item_indexes, clothing_items_collection)
+        await asyncio.to_thread(description_cache.ensure_indexes)
+        if isinstance(sessions, MongoSessionStore):
+            await asyncio.to_thread(sessions.ensure_indexes)
+    except Exception:
+        logging.exception("Не удалось создать индексы MongoDB")
+    try:
+        await llm_worker.warm_up()
+    except Exception:
+        logging.exception("Не удалось загрузить модель, загрузка повторится при первом запросе")
     else:
-        user_states[chat_id]["data"]["body_type"] = body_type_text
-        set_age_group_options(chat_id)
+        logging.info("Бот готов к работе")
 
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_BUDGET)
-async def handle_budget(message: types.Message):
-    chat_id = message.chat.id
-    budget = message.text
+async def main():
+    if not TELEGRAM_TOKEN:
+        raise ValueError("Telegram token not found in environment variables.")
+    run_in_background(warm_up())
     try:
-        budget = int(budget)
-        user_states[chat_id]["data"]["budget"] = budget
-
-        # Получаем параметры для API
-        occasion = user_states[chat_id]["data"].get("occasion")
-        category = user_states[chat_id]["data"].get("category")
-        style_preferences = user_states[chat_id]["data"].get("style_preferences", [])
-        body_type = user_states[chat_id]["data"].get("body_type")
-        age_group = user_states[chat_id]["data"].get("age_group")
+        await bot.polling(non_stop=True)
+    finally:
+        await llm_worker.close()
+        await cache_writer.close()
+        await wildberries_client.close()
 
-        # Запрашиваем образы с API
-        clothing_items = await get_clothing_items_from_api(occasion, category, style_preferences, budget, body_type, age_group)
-
-        # Кэшируем полученные образы
-        cache_clothing_items(clothing_items)
-
-        # Генерируем описание образа
-        outfit_description = generate_outfit_description(clothing_items, occasion, category, style_preferences, body_type, age_group)
-
-        # Форматируем и отправляем результат
-        outfit_result = format_outfit_result(clothing_items, outfit_description)
-        send_outfit_result(chat_id, outfit_result)
-
-
-    except ValueError:
-        bot.send_message(chat_id, "Пожалуйста, введите бюджет числом.")
-
-def handle_back(chat_id: int):
-    """Обработчик для кнопки "Назад"."""
-    if chat_id not in user_states:
-        bot.send_message(chat_id, "Вы в самом начале диалога. Некуда возвращаться.")
-        return
-
-    if len(user_states[chat_id]["history"]) > 1:
-        user_states[chat_id]["history"].pop()
-        previous_state = user_states[chat_id]["history"][-1]["state"]
-        if previous_state == STATE_OCCASION:
-            set_occasion_buttons(chat_id)
-        elif previous_state == STATE_STYLE_PREFERENCES:
-            set_style_preferences_options(chat_id)
-        elif previous_state == STATE_BUDGET:
-            set_budget_options(chat_id)
-        elif previous_state == STATE_BODY_TYPE:
-            set_body_type_options(chat_id)
-        elif previous_state == STATE_AGE_GROUP:
-            set_age_group_options(chat_id)
-        else:
-            bot.send_message(chat_id, "Неизвестное предыдущее состояние.")
-    else:
-        bot.send_message(chat_id, "Вы в самом начале диалога.")
-
-# 12. Запуск бота
 if __name__ == "__main__":
     logging.info("Starting Telegram bot...")
-    asyncio.run(bot.polling(none_stop=True))
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
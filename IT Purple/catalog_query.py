@@ -0,0 +1,289 @@
+import json
+from functools import lru_cache
+from time import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from outfit_render import rank_scores
+
+# Необязательные ускорители разбора ответа: msgspec разбирает только нужные
+# поля сразу в типизированные записи, orjson — быстрый разбор всего JSON
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 1. Настройка
+# Постоянные параметры запроса к каталогу Wildberries
+BASE_QUERY = {
+    'appType': '1',
+    'curr': 'rub',
+    'dest': '-1185367',
+    'sort': 'popular',
+    'spp': '30',
+}
+
+# Фильтр fcolor каталога принимает цвет как RGB-код в десятичном виде
+COLOR_CODES = {
+    "черный": 0,
+    "белый": 0xFFFFFF,
+    "красный": 0xFF0000,
+    "синий": 0x0000FF,
+    "зеленый": 0x008000,
+    "желтый": 0xFFFF00,
+}
+
+MARKETPLACE_URL = "https://www.wildberries.ru/catalog/{}/detail.aspx"
+# Сколько разных наборов размеров помнит expand_sizes: сетки размеров на странице повторяются
+SIZE_CACHE_SIZE = 4096
+
+# Чем разбирается ответ каталога в decode_catalog
+JSON_BACKEND = "msgspec" if msgspec is not None else "orjson" if orjson is not None else "json"
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def normalize_value(value: str) -> str:
+    """Приводит цвет или размер к виду для сравнения: без регистра, пробелов по краям и «ё»."""
+    return value.strip().casefold().replace("ё", "е")
+
+
+# 2. Запрос к каталогу
+def build_catalog_query(category_id: Optional[str], budget: Optional[float] = None, min_price: float = 0,
+                        color: Optional[str] = None) -> Dict[str, str]:
+    """Параметры запроса к каталогу с фильтрами, которые Wildberries применяет на своей стороне.
+
+    Цена передаётся диапазоном priceU в копейках, цвет — кодом fcolor, если
+    он есть в COLOR_CODES. Остальные ограничения (размер) проверяет
+    select_products: у фильтров каталога по ним внутренние id, а не значения.
+    Без category_id параметр cat не передаётся.
+    """
+    query = dict(BASE_QUERY)
+    if category_id is not None:
+        query["cat"] = category_id
+    if budget:
+        query["priceU"] = f"{int(min_price * 100)};{int(budget * 100)}"
+    color_code = COLOR_CODES.get(normalize_value(color)) if color else None
+    if color_code is not None:
+        query["fcolor"] = str(color_code)
+    return query
+
+
+# 3. Разбор ответа
+@lru_cache(maxsize=SIZE_CACHE_SIZE)
+def expand_sizes(names: Tuple[Any, ...]) -> Tuple[str, ...]:
+    """Размеры товара из имён и исходных обозначений, «44-46» даёт ещё и «44», «46».
+
+    Одинаковые наборы имён дают один и тот же кортеж, так что товары с
+    одной сеткой размеров делят его и не разбирают её заново.
+    """
+    sizes = set()
+    for name in names:
+        if name:
+            name = normalize_value(str(name))
+            sizes.add(name)
+            sizes.update(part for part in name.replace("/", "-").split("-") if part)
+    return tuple(sorted(sizes))
+
+
+def product_price(product: Dict[str, Any]) -> float:
+    """Цена товара в рублях: со скидкой, если она есть в ответе."""
+    return product.get("salePriceU", product.get("priceU", 0)) / 100
+
+
+def product_sizes(product: Dict[str, Any]) -> Tuple[str, ...]:
+    return expand_sizes(tuple(name for size in product.get("sizes") or ()
+                              for name in (size.get("name"), size.get("origName"))))
+
+
+def product_colors(product: Dict[str, Any]) -> List[str]:
+    return [normalize_value(color["name"]) for color in product.get("colors") or () if color.get("name")]
+
+
+class ProductBatch:
+    """Товары одной страницы каталога, разложенные по столбцам.
+
+    Вместо словаря на товар — по списку или массиву numpy на поле: цены,
+    рейтинги и число отзывов сразу лежат в массивах для select_products,
+    размеры и цвета уже нормализованы. В таком виде страница хранится в
+    кэше запросов; записи кэша товаров (to_items) собираются только для
+    отобранных товаров.
+    """
+
+    __slots__ = ("ids", "names", "brands", "images", "prices", "ratings", "feedbacks", "sizes", "colors")
+
+    def __init__(self, ids: Sequence[int], names: List[str], brands: List[str], images: List[str],
+                 prices: Sequence[float], ratings: Sequence[float], feedbacks: Sequence[float],
+                 sizes: List[Sequence[str]], colors: List[List[str]]):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = names
+        self.brands = brands
+        self.images = images
+        self.prices = np.asarray(prices, dtype=float)
+        self.ratings = np.asarray(ratings, dtype=float)
+        self.feedbacks = np.asarray(feedbacks, dtype=float)
+        self.sizes = sizes
+        self.colors = colors
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def from_products(cls, products: List[Dict[str, Any]]) -> "ProductBatch":
+        """Страница из товаров, разобранных в словари (json_loads)."""
+        return cls(
+            [product["id"] for product in products],
+            [product.get("name", "") for product in products],
+            [product.get("brand", "") for product in products],
+            [product.get("image", "") for product in products],
+            [product_price(product) for product in products],
+            [product.get("reviewRating", product.get("rating", 0)) or 0 for product in products],
+            [product.get("feedbacks", 0) or 0 for product in products],
+            [product_sizes(product) for product in products],
+            [product_colors(product) for product in products],
+        )
+
+    def take(self, indices: Sequence[int]) -> "ProductBatch":
+        """Товары с данными номерами в данном порядке."""
+        indices = np.asarray(indices, dtype=int)
+        return ProductBatch(
+            self.ids[indices],
+            [self.names[i] for i in indices],
+            [self.brands[i] for i in indices],
+            [self.images[i] for i in indices],
+            self.prices[indices],
+            self.ratings[indices],
+            self.feedbacks[indices],
+            [self.sizes[i] for i in indices],
+            [self.colors[i] for i in indices],
+        )
+
+    def to_items(self, category_id: str) -> List[Dict[str, Any]]:
+        """Товары в виде записей кэша товаров; время обновления одно на всю страницу."""
+        now = time()
+        return [
+            {
+                "_id": product_id,
+                "name": name,
+                "description": brand,
+                "price": price,
+                "rating": rating,
+                "feedbacks": int(feedbacks),
+                "sizes": list(sizes),
+                "colors": colors,
+                "image_url": image,
+                "marketplace_url": MARKETPLACE_URL.format(product_id),
+                "items": [],
+                "category_id": category_id,
+                "last_updated": now
+            }
+            for product_id, name, brand, image, price, rating, feedbacks, sizes, colors in zip(
+                self.ids.tolist(), self.names, self.brands, self.images, self.prices.tolist(),
+                self.ratings.tolist(), self.feedbacks.tolist(), self.sizes, self.colors)
+        ]
+
+    def to_document(self) -> Dict[str, list]:
+        """Столбцы обычными списками — для общего кэша запросов в MongoDB."""
+        document = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            document[name] = value.tolist() if isinstance(value, np.ndarray) else value
+        return document
+
+    @classmethod
+    def from_document(cls, document: Dict[str, list]) -> "ProductBatch":
+        return cls(*(document[name] for name in cls.__slots__))
+
+
+if msgspec is not None:
+    # Схема ответа: msgspec пропускает все остальные поля, не создавая для них объектов
+    class _Size(msgspec.Struct):
+        name: Optional[str] = None
+        origName: Optional[str] = None
+
+    class _Color(msgspec.Struct):
+        name: Optional[str] = None
+
+    class _Product(msgspec.Struct):
+        id: int
+        name: str = ""
+        brand: str = ""
+        image: str = ""
+        priceU: int = 0
+        salePriceU: Optional[int] = None
+        reviewRating: Optional[float] = None
+        rating: Optional[float] = None
+        feedbacks: Optional[int] = None
+        sizes: Optional[List[_Size]] = None
+        colors: Optional[List[_Color]] = None
+
+    class _Data(msgspec.Struct):
+        products: Optional[List[_Product]] = None
+
+    class _Catalog(msgspec.Struct):
+        data: Optional[_Data] = None
+
+    _catalog_decoder = msgspec.json.Decoder(_Catalog)
+
+    def _decode_products(body: bytes) -> ProductBatch:
+        data = _catalog_decoder.decode(body).data
+        products = (data.products if data is not None else None) or []
+        return ProductBatch(
+            [product.id for product in products],
+            [product.name for product in products],
+            [product.brand for product in products],
+            [product.image for product in products],
+            [(product.priceU if product.salePriceU is None else product.salePriceU) / 100 for product in products],
+            [(product.rating if product.reviewRating is None else product.reviewRating) or 0 for product in products],
+            [product.feedbacks or 0 for product in products],
+            [expand_sizes(tuple(name for size in product.sizes or () for name in (size.name, size.origName)))
+             for product in products],
+            [[normalize_value(color.name) for color in product.colors or () if color.name]
+             for product in products],
+        )
+else:
+    def _decode_products(body: bytes) -> ProductBatch:
+        data = json_loads(body).get("data") or {}
+        return ProductBatch.from_products(data.get("products") or [])
+
+
+def decode_catalog(body: bytes) -> ProductBatch:
+    """Разбирает тело ответа каталога сразу в ProductBatch.
+
+    С msgspec читаются только нужные поля товаров, без него — весь JSON
+    через orjson (или json) и затем ProductBatch.from_products.
+    """
+    return _decode_products(body)
+
+
+# 4. Отбор товаров из ответа
+def _matches(values: List[Sequence[str]], wanted: str) -> np.ndarray:
+    # Товары без данных о размерах или цветах не отбрасываются
+    return np.fromiter((not row or wanted in row for row in values), dtype=bool, count=len(values))
+
+
+def select_products(products: ProductBatch, budget: Optional[float] = None, min_price: float = 0,
+                    size: Optional[str] = None, color: Optional[str] = None,
+                    limit: Optional[int] = None) -> ProductBatch:
+    """Товары страницы, подходящие под ограничения, от лучших к худшим.
+
+    Фильтр по цене и ранжирование (rank_scores) считаются по столбцам
+    ProductBatch сразу для всей страницы. Размер и цвет проверяются по
+    спискам товара, только если заданы. При равной оценке сохраняется
+    порядок каталога.
+    """
+    mask = products.prices >= min_price
+    if budget:
+        mask &= products.prices <= budget
+    if size:
+        mask &= _matches(products.sizes, normalize_value(size))
+    if color:
+        mask &= _matches(products.colors, normalize_value(color))
+    selected = np.flatnonzero(mask)
+    scores = rank_scores(products.ratings[selected], products.feedbacks[selected])
+    order = np.argsort(-scores, kind="stable")[:limit]
+    return products.take(selected[order])
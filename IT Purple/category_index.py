@@ -0,0 +1,101 @@
+import csv
+import logging
+import os
+from typing import Dict, List, Optional, Set
+
+# 1. Настройка
+# Столбцы меню, в которых через запятую перечислены допустимые значения.
+# Пустая ячейка означает, что категория подходит для любого значения.
+FACETS = ("situation", "style", "color", "composition", "original", "season")
+
+
+def normalize(value: str) -> str:
+    """Приводит значение к виду для сравнения: без лишних пробелов и регистра."""
+    return " ".join(value.split()).casefold()
+
+
+def split_values(cell: Optional[str]) -> List[str]:
+    """Разбивает ячейку меню на нормализованные значения, пустые отбрасываются."""
+    return [normalize(value) for value in (cell or "").split(",") if value.strip()]
+
+
+# 2. Индекс категорий
+class CategoryIndex:
+    """Меню категорий Wildberries в памяти с обратным индексом по столбцам FACETS.
+
+    Файл читается один раз и перечитывается, только когда у него меняется
+    время изменения или размер. Для каждого столбца хранится отображение
+    «значение -> id категорий» и множество категорий с пустой ячейкой, так
+    что фильтрация сводится к пересечению множеств.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._signature = None
+        self._rows: Dict[str, Dict[str, str]] = {}
+        self._position: Dict[str, int] = {}
+        self._index: Dict[str, Dict[str, Set[str]]] = {}
+        self._wildcard: Dict[str, Set[str]] = {}
+
+    def _load(self):
+        rows, index = {}, {facet: {} for facet in FACETS}
+        wildcard = {facet: set() for facet in FACETS}
+        with open(self.filename, 'r', encoding='utf-8', newline='') as csvfile:
+            # skipinitialspace: в меню после запятой бывают пробелы перед кавычками
+            reader = csv.DictReader(csvfile, skipinitialspace=True)
+            for row in reader:
+                if None in row:
+                    logging.warning(f"{self.filename}, строка {reader.line_num}: лишние ячейки {row[None]}")
+                row = {name: (value or "").strip() for name, value in row.items() if name is not None}
+                category_id = row["id"]
+                if "slot" in row and not row["slot"]:
+                    logging.warning(f"{self.filename}: у категории {category_id} не задан слот образа")
+                rows[category_id] = row
+                for facet in FACETS:
+                    values = split_values(row.get(facet))
+                    if not values:
+                        wildcard[facet].add(category_id)
+                    for value in values:
+                        index[facet].setdefault(value, set()).add(category_id)
+        self._rows = rows
+        self._position = {category_id: position for position, category_id in enumerate(rows)}
+        self._index = index
+        self._wildcard = wildcard
+        logging.info(f"Загружено {len(rows)} категорий из {self.filename}")
+
+    def _maybe_reload(self):
+        stat = os.stat(self.filename)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self._signature:
+            self._load()
+            self._signature = signature
+
+    def version(self):
+        """Версия меню; меняется, когда файл перечитывается после изменения."""
+        self._maybe_reload()
+        return self._signature
+
+    def find(self, **filters: Optional[str]) -> List[Dict[str, str]]:
+        """Категории, подходящие под все заданные фильтры, в порядке файла.
+
+        Пустые фильтры и фильтры по столбцам, которых нет в меню, не ограничивают выборку.
+        """
+        self._maybe_reload()
+        matched: Optional[Set[str]] = None
+        for facet, value in filters.items():
+            if not value or facet not in self._index:
+                continue
+            ids = self._index[facet].get(normalize(value), set()) | self._wildcard[facet]
+            matched = ids if matched is None else matched & ids
+        if matched is None:
+            return list(self._rows.values())
+        return [self._rows[category_id] for category_id in sorted(matched, key=self._position.__getitem__)]
+
+    def has_value(self, facet: str, value: str) -> bool:
+        """Указано ли значение явно хотя бы у одной категории (пустые ячейки не в счёт)."""
+        self._maybe_reload()
+        return bool(self._index.get(facet, {}).get(normalize(value)))
+
+    def get(self, category_id: str) -> Optional[Dict[str, str]]:
+        self._maybe_reload()
+        return self._rows.get(category_id)
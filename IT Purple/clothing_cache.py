@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from time import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+
+# 1. Настройка
+# Отложенная запись: товары копятся в очереди и пишутся одним bulk_write,
+# как только набралось CACHE_WRITE_BATCH_SIZE товаров или прошло
+# CACHE_WRITE_INTERVAL секунд с первого товара в пачке
+CACHE_WRITE_BATCH_SIZE = 500
+CACHE_WRITE_INTERVAL = 1.0
+# Сколько ответов API может ждать записи; лишние отбрасываются с предупреждением
+CACHE_WRITE_QUEUE_SIZE = 1000
+
+# Выдача из кэша: товары старше CACHE_MAX_AGE секунд считаются устаревшими,
+# за один запрос читается не больше CACHE_QUERY_LIMIT документов
+CACHE_MAX_AGE = 6 * 60 * 60
+CACHE_QUERY_LIMIT = 20
+# Поля, которые нужны для ответа пользователю
+ITEM_PROJECTION = {"name": 1, "description": 1, "price": 1, "image_url": 1, "marketplace_url": 1, "items": 1,
+                   "rating": 1, "feedbacks": 1}
+
+
+# 2. Запись и чтение кэша товаров
+def bulk_upsert_items(collection, clothing_items: Iterable[Dict[str, Any]]) -> int:
+    """Записывает товары в коллекцию одним неупорядоченным bulk upsert.
+
+    collection — коллекция pymongo или совместимая (например, mongomock).
+    Возвращает число добавленных и изменённых документов.
+    """
+    operations = [UpdateOne({"_id": item["_id"]}, {"$set": item}, upsert=True) for item in clothing_items]
+    if not operations:
+        return 0
+    result = collection.bulk_write(operations, ordered=False)
+    return result.upserted_count + result.modified_count
+
+
+def ensure_item_indexes(collection):
+    """Создаёт составные индексы под find_cached_items (повторный вызов ничего не меняет).
+
+    category_fresh отдаёт товары категории сразу от свежих к старым, так
+    что запрос с limit останавливается на первых подходящих.
+    category_price_fresh (равенство по category_id, диапазон по price,
+    last_updated в конце ключа) подходит, когда бюджет отсекает почти всю
+    категорию: тогда MongoDB выберет его и досортирует немногие совпадения.
+    """
+    collection.create_index([("category_id", ASCENDING), ("price", ASCENDING), ("last_updated", DESCENDING)],
+                            name="category_price_fresh")
+    collection.create_index([("category_id", ASCENDING), ("last_updated", DESCENDING)],
+                            name="category_fresh")
+
+
+def find_cached_items(collection, category_id: Any, budget: Optional[float] = None, min_price: float = 0,
+                      size: Optional[str] = None, color: Optional[str] = None, max_age: float = CACHE_MAX_AGE,
+                      limit: int = CACHE_QUERY_LIMIT) -> List[Dict[str, Any]]:
+    """Ищет в кэше свежие товары категории в пределах бюджета.
+
+    Бюджет, size и color (уже нормализованные, должны быть в списках sizes
+    и colors товара) только отсекают товары; порядок — от самых свежих,
+    а лучшие из них выбирают rank_items и сборщик образа. Результат
+    ограничен limit документами и только полями ITEM_PROJECTION.
+    """
+    query: Dict[str, Any] = {"category_id": category_id, "last_updated": {"$gte": time() - max_age}}
+    if size:
+        query["sizes"] = size
+    if color:
+        query["colors"] = color
+    if budget is not None:
+        query["price"] = {"$gte": min_price, "$lte": budget}
+    return list(collection.find(query, ITEM_PROJECTION).sort("last_updated", DESCENDING).limit(limit))
+
+
+# 3. Фоновая запись
+class CacheWriter:
+    """Фоновая (write-behind) запись товаров в кэш MongoDB.
+
+    submit() только кладёт ответ API в очередь и сразу возвращается;
+    фоновая задача собирает пачки, убирает повторы по _id и пишет их
+    через bulk_upsert_items в отдельном потоке. close() дописывает всё,
+    что осталось в очереди.
+    """
+
+    def __init__(self, collection, batch_size: int = CACHE_WRITE_BATCH_SIZE,
+                 flush_interval: float = CACHE_WRITE_INTERVAL, max_pending: int = CACHE_WRITE_QUEUE_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._task: Optional[asyncio.Task] = None
+
+    def submit(self, clothing_items: List[Dict[str, Any]]):
+        """Ставит товары в очередь на запись. Вызывается из цикла событий."""
+        if not clothing_items:
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait(clothing_items)
+        except asyncio.QueueFull:
+            logging.warning(f"Очередь записи кэша переполнена, {len(clothing_items)} товаров не сохранены")
+
+    async def _flush(self, batch: Dict[Any, Dict[str, Any]]):
+        try:
+            written = await asyncio.to_thread(bulk_upsert_items, self.collection, batch.values())
+            logging.debug(f"Кэш товаров: записано {written} из {len(batch)}")
+        except Exception:
+            logging.exception(f"Не удалось записать в кэш {len(batch)} товаров")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            clothing_items = await self._queue.get()
+            if clothing_items is None:
+                break
+            batch = {item["_id"]: item for item in clothing_items}
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    clothing_items = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if clothing_items is None:
+                    stopping = True
+                    break
+                batch.update((item["_id"], item) for item in clothing_items)
+            await self._flush(batch)
+
+    async def close(self):
+        """Дописывает очередь и останавливает фоновую задачу."""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import re
+from time import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+
+# 1. Настройка
+# Сколько описаний хранится; при переполнении удаляются давно не запрошенные
+DESCRIPTION_CACHE_SIZE = 10000
+# Удаляем с запасом, чтобы не вытеснять по одной записи на каждую вставку
+DESCRIPTION_EVICT_SLACK = 100
+# Сколько описаний с теми же параметрами сравнивается при поиске похожего образа
+NEAR_DUPLICATE_CANDIDATES = 200
+
+WORD_RE = re.compile(r"\w+")
+
+
+# 2. Нормализация входа
+def _normalize(value: Any) -> str:
+    return " ".join(str(value).lower().split())
+
+
+def _normalize_choices(choices: Dict[str, Any]) -> List[Tuple[str, Any]]:
+    normalized = []
+    for name, value in sorted(choices.items()):
+        if isinstance(value, (list, tuple, set)):
+            value = sorted(_normalize(v) for v in value)
+        elif value is not None:
+            value = _normalize(value)
+        normalized.append((name, value))
+    return normalized
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha1(json.dumps(value, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def item_tokens(item_names: Iterable[str]) -> List[str]:
+    """Множество слов из названий товаров (для сравнения похожих образов)."""
+    return sorted({word for name in item_names for word in WORD_RE.findall(name.lower())})
+
+
+def jaccard(a: Iterable[str], b: Iterable[str]) -> float:
+    a, b = set(a), set(b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+# 3. Кэш описаний
+class DescriptionCache:
+    """Кэш сгенерированных описаний образов в коллекции MongoDB.
+
+    Ключ — хэш нормализованных названий товаров (без учёта порядка и
+    регистра) и параметров выбора пользователя. Размер ограничен
+    max_entries: лишние записи вытесняются по времени последнего запроса
+    (LRU). Если задан near_duplicate_threshold, при промахе ищется описание
+    с теми же параметрами и похожим набором слов в названиях
+    (коэффициент Жаккара не ниже порога).
+    """
+
+    def __init__(self, collection, max_entries: int = DESCRIPTION_CACHE_SIZE,
+                 near_duplicate_threshold: Optional[float] = None):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.near_duplicate_threshold = near_duplicate_threshold
+
+    def ensure_indexes(self):
+        self.collection.create_index([("last_used", ASCENDING)], name="lru")
+        self.collection.create_index([("choices_hash", ASCENDING), ("last_used", DESCENDING)], name="choices")
+
+    @staticmethod
+    def make_key(item_names: Iterable[str], choices: Dict[str, Any]) -> Tuple[str, str]:
+        """Возвращает (ключ описания, ключ одних только параметров выбора)."""
+        choices_hash = _digest(_normalize_choices(choices))
+        items = sorted(_normalize(name) for name in item_names)
+        return _digest([items, choices_hash]), choices_hash
+
+    def lookup(self, item_names: List[str], choices: Dict[str, Any]) -> Optional[str]:
+        """Возвращает закэшированное описание образа или None."""
+        key, choices_hash = self.make_key(item_names, choices)
+        now = time()
+        document = self.collection.find_one_and_update(
+            {"_id": key}, {"$set": {"last_used": now}, "$inc": {"hits": 1}}, projection={"description": 1})
+        if document is not None:
+            return document["description"]
+        if self.near_duplicate_threshold is None:
+            return None
+
+        tokens = item_tokens(item_names)
+        best_id, best_description, best_score = None, None, self.near_duplicate_threshold
+        candidates = self.collection.find({"choices_hash": choices_hash}, {"tokens": 1, "description": 1})
+        for candidate in candidates.sort("last_used", DESCENDING).limit(NEAR_DUPLICATE_CANDIDATES):
+            score = jaccard(tokens, candidate["tokens"])
+            if score >= best_score:
+                best_id, best_description, best_score = candidate["_id"], candidate["description"], score
+        if best_id is not None:
+            self.collection.update_one({"_id": best_id}, {"$set": {"last_used": now}, "$inc": {"hits": 1}})
+        return best_description
+
+    def store(self, item_names: List[str], choices: Dict[str, Any], description: str):
+        """Сохраняет описание и при переполнении вытесняет давно не запрошенные."""
+        key, choices_hash = self.make_key(item_names, choices)
+        now = time()
+        self.collection.replace_one(
+            {"_id": key},
+            {"_id": key, "choices_hash": choices_hash, "tokens": item_tokens(item_names),
+             "description": description, "created": now, "last_used": now, "hits": 0},
+            upsert=True,
+        )
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess > 0:
+            stale = self.collection.find({"_id": {"$ne": key}}, {"_id": 1}).sort("last_used", ASCENDING).limit(
+                excess + DESCRIPTION_EVICT_SLACK)
+            self.collection.delete_many({"_id": {"$in": [document["_id"] for document in stale]}})
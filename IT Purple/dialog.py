@@ -0,0 +1,149 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from session_store import current_state, push_state
+
+# 1. Настройка
+BACK = "Назад"
+# Значение кнопки «Назад» в callback_data инлайн-клавиатур
+BACK_CHOICE = "back"
+
+AT_START_TEXT = "Вы в самом начале диалога."
+CHOOSE_OPTION_TEXT = "Пожалуйста, выберите один из предложенных вариантов."
+
+# Сообщение бота: текст и клавиатура (или None)
+Message = Tuple[str, Any]
+Send = Callable[[int, str, Any], Awaitable[Any]]
+Finish = Callable[[int, Dict[str, Any]], Awaitable[Any]]
+
+
+class InvalidInput(Exception):
+    """Ответ пользователя не подходит для шага; текст исключения показывается пользователю.
+
+    reprompt=True — после сообщения об ошибке шаг задаётся заново.
+    """
+
+    def __init__(self, message: str, reprompt: bool = False):
+        super().__init__(message)
+        self.reprompt = reprompt
+
+
+def keep_text(text: str, data: Dict[str, Any]) -> str:
+    return text
+
+
+def fixed_prompt(text: str, markup: Any = None) -> Callable[[Dict[str, Any]], Message]:
+    """Вопрос шага, который не зависит от ответов пользователя."""
+    message = (text, markup)
+    return lambda data: message
+
+
+# 2. Шаги диалога
+class Step:
+    """Описание одного шага диалога.
+
+    prompt(data) строит сообщение (текст и клавиатуру), которым бот задаёт
+    вопрос шага; на каждый шаг отправляется одно сообщение.
+    parse(text, data) превращает ответ (введённый текст или значение кнопки)
+    в значение поля data[field] или бросает InvalidInput. next_state —
+    следующий шаг, None — последний шаг, после него вызывается finish.
+    text_input=False — шаг принимает только нажатия инлайн-кнопок.
+    other — (надпись кнопки, сообщение): при выборе «Другое» бот просит
+    ввести свой вариант и остаётся на шаге.
+    """
+
+    __slots__ = ("state", "prompt", "parse", "field", "next_state", "text_input", "other")
+
+    def __init__(self, state: str, prompt: Callable[[Dict[str, Any]], Message], next_state: Optional[str],
+                 parse: Callable[[str, Dict[str, Any]], Any] = keep_text, field: Optional[str] = None,
+                 text_input: bool = True, other: Optional[Tuple[str, Message]] = None):
+        self.state = state
+        self.prompt = prompt
+        self.parse = parse
+        self.field = field or state
+        self.next_state = next_state
+        self.text_input = text_input
+        self.other = other
+
+
+# 3. Движок диалога
+class DialogMachine:
+    """Диалог как таблица шагов: состояние -> Step.
+
+    Обработчик ответа находится по текущему состоянию сессии одним
+    обращением к словарю, поэтому стоимость маршрутизации не зависит от
+    числа шагов. Движок не знает о Telegram: сообщения отправляются через
+    send(chat_id, text, markup), а собранные ответы передаются в
+    finish(chat_id, data). Сессия — словарь из session_store, сохраняет её
+    вызывающий код.
+    """
+
+    def __init__(self, steps: List[Step], send: Send, finish: Finish):
+        self.steps: Dict[str, Step] = {step.state: step for step in steps}
+        self.first_state = steps[0].state
+        self.send = send
+        self.finish = finish
+
+    async def enter(self, chat_id: int, session: Dict[str, Any], state: str):
+        """Задаёт вопрос шага state и делает его текущим."""
+        text, markup = self.steps[state].prompt(session["data"])
+        await self.send(chat_id, text, markup)
+        push_state(session, state)
+
+    async def start(self, chat_id: int, session: Dict[str, Any]):
+        """Начинает диалог заново с первого шага."""
+        session["history"].clear()
+        session["data"].clear()
+        await self.enter(chat_id, session, self.first_state)
+
+    async def back(self, chat_id: int, session: Dict[str, Any]):
+        """Возвращает к предыдущему шагу."""
+        if len(session["history"]) < 2:
+            await self.send(chat_id, AT_START_TEXT, None)
+            return
+        session["history"].pop()
+        await self.enter(chat_id, session, current_state(session))
+
+    async def handle_text(self, chat_id: int, session: Dict[str, Any], text: str):
+        """Обрабатывает введённый текст как ответ на текущий шаг."""
+        if text == BACK:
+            await self.back(chat_id, session)
+            return
+        step = self.steps.get(current_state(session))
+        if step is None or not step.text_input:
+            await self.send(chat_id, CHOOSE_OPTION_TEXT, None)
+            return
+        await self._answer(chat_id, session, step, text)
+
+    async def handle_choice(self, chat_id: int, session: Dict[str, Any], state: str, value: str):
+        """Обрабатывает нажатие инлайн-кнопки шага state со значением value."""
+        step = self.steps.get(state)
+        if step is None:
+            await self.send(chat_id, CHOOSE_OPTION_TEXT, None)
+            return
+        if value == BACK_CHOICE:
+            await self.back(chat_id, session)
+            return
+        # Кнопка могла остаться от более раннего шага — тогда диалог продолжается с него
+        push_state(session, state)
+        await self._answer(chat_id, session, step, value)
+
+    async def _answer(self, chat_id: int, session: Dict[str, Any], step: Step, answer: str):
+        if step.other is not None and answer == step.other[0]:
+            text, markup = step.other[1]
+            await self.send(chat_id, text, markup)
+            return
+        data = session["data"]
+        try:
+            value = step.parse(answer, data)
+        except InvalidInput as e:
+            await self.send(chat_id, str(e), None)
+            if e.reprompt:
+                await self.enter(chat_id, session, step.state)
+            return
+        data[step.field] = value
+        logging.info(f"User {chat_id} selected {step.field}: {value}")
+        if step.next_state is None:
+            await self.finish(chat_id, data)
+        else:
+            await self.enter(chat_id, session, step.next_state)
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, Optional, Tuple, Union
+
+from telebot import types
+
+from dialog import BACK, BACK_CHOICE
+
+# 1. Настройка
+# Сколько динамических клавиатур (например, категорий по ситуациям) держится в кэше
+KEYBOARD_CACHE_SIZE = 256
+
+# Готовые ForceReply в JSON: Bot API принимает reply_markup строкой как есть
+FORCE_REPLY = types.ForceReply(selective=False).to_json()
+FORCE_REPLY_SELECTIVE = types.ForceReply(selective=True).to_json()
+
+Option = Union[str, Tuple[str, str]]
+
+
+# 2. Построение клавиатур
+def inline_keyboard(state: str, options: Iterable[Option], other: Optional[str] = None, back: bool = True) -> str:
+    """Инлайн-клавиатура шага state, сериализованная в JSON.
+
+    options — надписи кнопок или пары (надпись, значение); callback_data
+    кнопки — «state:значение». Кнопки «Другое» (other) и «Назад» идут
+    последней строкой.
+    """
+    markup = types.InlineKeyboardMarkup()
+    for option in options:
+        label, value = (option, option) if isinstance(option, str) else option
+        markup.add(types.InlineKeyboardButton(label, callback_data=f"{state}:{value}"))
+    last_row = []
+    if other:
+        last_row.append(types.InlineKeyboardButton(other, callback_data=f"{state}:{other}"))
+    if back:
+        last_row.append(types.InlineKeyboardButton(BACK, callback_data=f"{state}:{BACK_CHOICE}"))
+    if last_row:
+        markup.row(*last_row)
+    return markup.to_json()
+
+
+# 3. Реестр клавиатур
+class KeyboardRegistry:
+    """Клавиатуры, сериализованные в JSON один раз и переиспользуемые во всех чатах.
+
+    Статические клавиатуры регистрируются при запуске через add(). Клавиатуры,
+    зависящие от данных (категории по ситуации), строятся при первом
+    обращении к dynamic() и хранятся в LRU-кэше; смена version (например,
+    перечитанное меню категорий) сбрасывает этот кэш.
+    """
+
+    def __init__(self, max_dynamic: int = KEYBOARD_CACHE_SIZE):
+        self.max_dynamic = max_dynamic
+        self._static: Dict[str, str] = {}
+        self._dynamic: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._version = None
+
+    def add(self, name: str, markup: Union[str, types.JsonSerializable]):
+        self._static[name] = markup if isinstance(markup, str) else markup.to_json()
+
+    def __getitem__(self, name: str) -> str:
+        return self._static[name]
+
+    def dynamic(self, key: Hashable, build: Callable[[], str], version=None) -> str:
+        if version != self._version:
+            self._dynamic.clear()
+            self._version = version
+        markup = self._dynamic.get(key)
+        if markup is None:
+            markup = self._dynamic[key] = build()
+            while len(self._dynamic) > self.max_dynamic:
+                self._dynamic.popitem(last=False)
+        else:
+            self._dynamic.move_to_end(key)
+        return markup
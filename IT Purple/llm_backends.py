@@ -0,0 +1,166 @@
+from typing import Callable, List, Optional
+
+# 1. Настройка
+# Имена бэкендов для make_backend
+BACKEND_TRANSFORMERS = "transformers"  # модель transformers в fp32, как прежний pipeline
+BACKEND_INT8 = "int8"                  # та же модель с динамическим int8-квантованием Linear-слоёв (CPU)
+BACKEND_GGUF = "gguf"                  # 4-битная GGUF-модель в llama.cpp (CPU)
+
+Sink = Optional[Callable[[str], None]]
+
+
+# 2. Потоковая выдача токенов
+class BatchStreamer:
+    """Стример для model.generate, который раздаёт текст по строкам пачки.
+
+    Реализует интерфейс BaseStreamer из transformers (put/end), но не
+    наследует его, чтобы модуль импортировался без transformers.
+    generate() сначала передаёт в put() токены промпта, затем на каждом шаге
+    по одному новому токену на строку. Для каждой строки с приёмником
+    (sinks[i] не None) накопленные токены декодируются заново, и приёмнику
+    отдаётся только новый кусок текста. После eos строка больше не растёт.
+    """
+
+    def __init__(self, tokenizer, sinks: List[Sink]):
+        self.tokenizer = tokenizer
+        self.sinks = sinks
+        self._prompt_seen = False
+        self._tokens: List[List[int]] = [[] for _ in sinks]
+        self._sent = [0] * len(sinks)
+        self._finished = [False] * len(sinks)
+
+    def _emit(self, row: int, final: bool = False):
+        text = self.tokenizer.decode(self._tokens[row], skip_special_tokens=True)
+        # Незаконченный многобайтный символ декодируется в U+FFFD — ждём следующий токен
+        if not final and text.endswith("�"):
+            return
+        if len(text) > self._sent[row]:
+            self.sinks[row](text[self._sent[row]:])
+            self._sent[row] = len(text)
+
+    def put(self, value):
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        tokens = value.tolist() if value.dim() == 1 else value[:, -1].tolist()
+        for row, token in enumerate(tokens):
+            if self.sinks[row] is None or self._finished[row]:
+                continue
+            if token == self.tokenizer.eos_token_id:
+                self._finished[row] = True
+                continue
+            self._tokens[row].append(token)
+            self._emit(row)
+
+    def end(self):
+        for row, sink in enumerate(self.sinks):
+            if sink is not None:
+                self._emit(row, final=True)
+
+
+# 3. Бэкенды генерации
+# У каждого бэкенда одинаковый интерфейс: load() загружает модель,
+# generate_batch(prompts, sinks, max_new_tokens) возвращает продолжения
+# промптов и по ходу отдаёт куски текста в sinks[i], если он не None,
+# count_tokens(text) нужен для замеров скорости.
+class TransformersBackend:
+    """Модель transformers на PyTorch, вся пачка генерируется одним model.generate.
+
+    quantize="int8" применяет к Linear-слоям динамическое квантование
+    torch (веса в int8, активации квантуются на лету) — на CPU это
+    меньше памяти и быстрее матричные умножения, чем в fp32. Квантованная
+    модель всегда работает на CPU, device_map используется только без квантования.
+    """
+
+    def __init__(self, model_name: str, quantize: Optional[str] = None, device_map: Optional[str] = "auto",
+                 n_threads: Optional[int] = None, **generate_kwargs):
+        self.model_name = model_name
+        self.quantize = quantize
+        self.device_map = device_map
+        self.n_threads = n_threads
+        self.generate_kwargs = generate_kwargs or {"do_sample": True}
+        self.model = None
+        self.tokenizer = None
+
+    def load(self):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if self.n_threads:
+            torch.set_num_threads(self.n_threads)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        # Для пачки промптов разной длины у decoder-only моделей паддинг нужен слева
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+        if self.quantize == "int8":
+            model = AutoModelForCausalLM.from_pretrained(self.model_name).float()
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif self.quantize is None:
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, device_map=self.device_map)
+        else:
+            raise ValueError(f"Неизвестный режим квантования: {self.quantize}")
+        model.eval()
+        self.tokenizer = tokenizer
+        self.model = model
+
+    def generate_batch(self, prompts: List[str], sinks: List[Sink], max_new_tokens: int) -> List[str]:
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+        streamer = BatchStreamer(self.tokenizer, sinks) if any(sinks) else None
+        outputs = self.model.generate(**inputs, max_new_tokens=max_new_tokens, streamer=streamer,
+                                      pad_token_id=self.tokenizer.pad_token_id, **self.generate_kwargs)
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+class LlamaCppBackend:
+    """GGUF-модель (например, квантованная в Q4_K_M) в llama.cpp через llama-cpp-python.
+
+    llama.cpp сам по себе оптимизирован под CPU, но в python-обёртке нет
+    пакетной генерации, поэтому промпты пачки генерируются по очереди.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 2048, n_threads: Optional[int] = None, **generate_kwargs):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.generate_kwargs = generate_kwargs
+        self.model = None
+
+    def load(self):
+        from llama_cpp import Llama
+
+        self.model = Llama(model_path=self.model_path, n_ctx=self.n_ctx, n_threads=self.n_threads, verbose=False)
+
+    def generate_batch(self, prompts: List[str], sinks: List[Sink], max_new_tokens: int) -> List[str]:
+        texts = []
+        for prompt, sink in zip(prompts, sinks):
+            if sink is None:
+                result = self.model(prompt, max_tokens=max_new_tokens, **self.generate_kwargs)
+                texts.append(result["choices"][0]["text"])
+                continue
+            parts = []
+            for chunk in self.model(prompt, max_tokens=max_new_tokens, stream=True, **self.generate_kwargs):
+                text = chunk["choices"][0]["text"]
+                if text:
+                    parts.append(text)
+                    sink(text)
+            texts.append("".join(parts))
+        return texts
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False))
+
+
+def make_backend(name: str, model: str, **options):
+    """Создаёт бэкенд по имени; model — имя модели transformers или путь к .gguf."""
+    if name == BACKEND_TRANSFORMERS:
+        return TransformersBackend(model, **options)
+    if name == BACKEND_INT8:
+        return TransformersBackend(model, quantize="int8", **options)
+    if name == BACKEND_GGUF:
+        return LlamaCppBackend(model, **options)
+    raise ValueError(f"Неизвестный бэкенд генерации: {name}")
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Executor
+from typing import AsyncIterator, List, Optional
+
+from llm_backends import Sink
+
+# 1. Настройка
+# Запросы из разных чатов, пришедшие за LLM_BATCH_WAIT секунд, генерируются
+# одним вызовом бэкенда, но не больше LLM_BATCH_SIZE за раз
+LLM_BATCH_SIZE = 8
+LLM_BATCH_WAIT = 0.05
+# Длина ответа без учёта промпта (по умолчанию, бот задаёт свою)
+LLM_MAX_NEW_TOKENS = 200
+
+
+# 2. Воркер генерации
+class _Request:
+    __slots__ = ("prompt", "future", "chunks")
+
+    def __init__(self, prompt: str, future: asyncio.Future, chunks: Optional[asyncio.Queue]):
+        self.prompt = prompt
+        self.future = future
+        self.chunks = chunks
+
+
+class InferenceWorker:
+    """Очередь запросов к LLM с динамическим объединением в пачки.
+
+    generate() и stream() только ставят промпт в очередь; фоновая задача
+    собирает пачку из запросов, пришедших за max_wait секунд, и выполняет
+    один вызов backend.generate_batch в executor, поэтому цикл событий бота
+    не ждёт генерацию. stream() отдаёт текст по мере появления токенов.
+
+    backend — один из бэкендов llm_backends. Модель загружается в потоке
+    executor при первом запросе или при вызове warm_up().
+    """
+
+    def __init__(self, backend, executor: Executor, max_batch_size: int = LLM_BATCH_SIZE,
+                 max_wait: float = LLM_BATCH_WAIT, max_new_tokens: int = LLM_MAX_NEW_TOKENS):
+        self.backend = backend
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_new_tokens = max_new_tokens
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        """Модель загружена и запросы не будут ждать загрузки."""
+        return self._loaded
+
+    def _ensure_loaded(self):
+        with self._load_lock:
+            if self._loaded:
+                return
+            logging.info("Загрузка модели для генерации описаний...")
+            self.backend.load()
+            self._loaded = True
+            logging.info("Модель для генерации описаний загружена")
+
+    async def warm_up(self):
+        """Загружает модель заранее, не дожидаясь первого запроса."""
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._ensure_loaded)
+
+    def _submit(self, prompt: str, stream: bool) -> _Request:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        request = _Request(prompt, asyncio.get_running_loop().create_future(),
+                           asyncio.Queue() if stream else None)
+        self._queue.put_nowait(request)
+        return request
+
+    async def generate(self, prompt: str) -> str:
+        """Возвращает сгенерированное продолжение промпта целиком."""
+        return await self._submit(prompt, stream=False).future
+
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        """Отдаёт продолжение промпта кусками по мере генерации."""
+        request = self._submit(prompt, stream=True)
+        while True:
+            chunk = await request.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        await request.future
+
+    def _generate_batch(self, prompts: List[str], sinks: List[Sink]) -> List[str]:
+        self._ensure_loaded()
+        return self.backend.generate_batch(prompts, sinks, self.max_new_tokens)
+
+    async def _run_batch(self, batch: List[_Request]):
+        loop = asyncio.get_running_loop()
+        batch = [request for request in batch if not request.future.done()]
+        if not batch:
+            return
+        sinks = [
+            (lambda text, chunks=request.chunks: loop.call_soon_threadsafe(chunks.put_nowait, text))
+            if request.chunks is not None else None
+            for request in batch
+        ]
+        try:
+            texts = await loop.run_in_executor(self.executor, self._generate_batch,
+                                               [request.prompt for request in batch], sinks)
+        except Exception as e:
+            logging.exception(f"Ошибка генерации пачки из {len(batch)} промптов")
+            texts = None
+            error = e
+        for i, request in enumerate(batch):
+            if not request.future.done():
+                if texts is None:
+                    request.future.set_exception(error)
+                else:
+                    request.future.set_result(texts[i])
+            if request.chunks is not None:
+                request.chunks.put_nowait(None)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            request = await self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+            await self._run_batch(batch)
+
+    async def close(self):
+        """Дорабатывает уже поставленные запросы и останавливает воркер."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
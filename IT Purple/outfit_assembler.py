@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from outfit_render import rank_items, rank_scores
+
+# 1. Настройка
+# Слоты образа — значения столбца slot меню категорий
+SLOT_TOP = "верх"
+SLOT_BOTTOM = "низ"
+SLOT_FULL = "целиком"
+SLOT_OUTER = "верхняя одежда"
+
+# Варианты образа: (обязательные слоты, необязательные слоты)
+OUTFIT_TEMPLATES = [
+    ((SLOT_TOP, SLOT_BOTTOM), (SLOT_OUTER,)),
+    ((SLOT_FULL,), (SLOT_OUTER,)),
+]
+# Сколько товаров каждой категории читается из кэша и участвует в подборе. С запасом:
+# бюджет делится между слотами только в choose_items, и если взять лишь несколько
+# лучших товаров, они могут оказаться дорогими, а пара верх + низ не сложится
+OUTFIT_CANDIDATES = 50
+# Бюджет делится не больше чем на BUDGET_CELLS шагов, цены округляются до шага вверх
+BUDGET_CELLS = 1000
+BUDGET_MIN_STEP = 10
+# Надбавка за заполненный обязательный слот: полный образ всегда лучше неполного
+REQUIRED_SLOT_BONUS = 100.0
+
+Item = Dict[str, Any]
+
+
+# 2. Выбор товаров под бюджет
+def item_values(items: List[Item]) -> np.ndarray:
+    ratings = np.fromiter((item.get("rating") or 0 for item in items), dtype=float, count=len(items))
+    feedbacks = np.fromiter((item.get("feedbacks") or 0 for item in items), dtype=float, count=len(items))
+    return rank_scores(ratings, feedbacks)
+
+
+def choose_items(groups: Sequence[Tuple[List[Item], bool]], budget: Optional[float],
+                 anchor: Optional[int] = None) -> List[Optional[Item]]:
+    """По одному товару из каждой группы (или ничего) с наибольшей суммарной оценкой в пределах бюджета.
+
+    groups — пары (товары, обязательна ли группа). Это задача о рюкзаке с
+    выбором из групп: dp[c] — лучшая сумма оценок при стоимости ровно c
+    шагов бюджета, для каждой группы dp пересчитывается сдвигами массива
+    на цену каждого товара. Обязательные группы получают надбавку
+    REQUIRED_SLOT_BONUS, поэтому пропускаются, только если на них не
+    хватает бюджета. Группа с номером anchor (категория, выбранная
+    пользователем) не пропускается никогда: если ни один её товар не
+    укладывается в бюджет, ничего не выбирается. Возвращает товар или
+    None для каждой группы.
+    """
+    if budget is None:
+        return [items[int(np.argmax(item_values(items)))] if items else None for items, _ in groups]
+    if budget < 0:
+        return [None] * len(groups)
+
+    step = max(BUDGET_MIN_STEP, budget / BUDGET_CELLS)
+    capacity = int(budget // step)
+    dp = np.full(capacity + 1, -np.inf)
+    dp[0] = 0.0
+    weights_by_group, choices = [], []
+    for group, (items, required) in enumerate(groups):
+        weights = np.ceil(np.array([item["price"] for item in items], dtype=float) / step).astype(int)
+        values = item_values(items) + (REQUIRED_SLOT_BONUS if required else 0.0)
+        # Вариант «ничего из группы» есть у всех групп, кроме anchor
+        best = np.full(capacity + 1, -np.inf) if group == anchor else dp.copy()
+        choice = np.full(capacity + 1, -1)
+        for index, (weight, value) in enumerate(zip(weights, values)):
+            if weight > capacity:
+                continue
+            candidate = np.full(capacity + 1, -np.inf)
+            candidate[weight:] = dp[:capacity + 1 - weight] + value
+            better = candidate > best
+            best[better] = candidate[better]
+            choice[better] = index
+        dp = best
+        weights_by_group.append(weights)
+        choices.append(choice)
+
+    # Восстанавливаем выбор с конца, начиная с самой выгодной стоимости
+    cost = int(np.argmax(dp))
+    chosen: List[Optional[Item]] = [None] * len(groups)
+    if dp[cost] == -np.inf:
+        return chosen
+    for group in range(len(groups) - 1, -1, -1):
+        index = choices[group][cost]
+        if index >= 0:
+            chosen[group] = groups[group][0][index]
+            cost -= weights_by_group[group][index]
+    return chosen
+
+
+def assemble_outfit(candidates: Dict[str, List[Item]], budget: Optional[float],
+                    anchor_slot: Optional[str] = None) -> List[Item]:
+    """Лучший образ из кандидатов по слотам: по товару на слот, суммарно не дороже budget.
+
+    Перебираются варианты OUTFIT_TEMPLATES (с anchor_slot — только те, где
+    он есть, и товар этого слота входит в образ обязательно). Полный образ
+    предпочитается неполному, а среди них — с большей средней оценкой
+    товаров. Если подходящего образа нет, возвращается пустой список.
+    """
+    best_key, best_outfit = None, []
+    for required, optional in OUTFIT_TEMPLATES:
+        slots = required + optional
+        if anchor_slot and anchor_slot not in slots:
+            continue
+        groups = [(candidates.get(slot, []), slot in required) for slot in slots]
+        chosen = choose_items(groups, budget, anchor=slots.index(anchor_slot) if anchor_slot else None)
+        outfit = [item for item in chosen if item is not None]
+        if not outfit:
+            continue
+        complete = all(item is not None for item in chosen[:len(required)])
+        key = (complete, float(item_values(outfit).mean()))
+        if best_key is None or key > best_key:
+            best_key, best_outfit = key, outfit
+    return best_outfit
+
+
+# 3. Сбор кандидатов
+async def fetch_candidates(categories: List[Dict[str, str]], fetch: Callable[[str], Awaitable[List[Item]]],
+                           budget: Optional[float] = None, anchor_id: Optional[str] = None,
+                           limit: int = OUTFIT_CANDIDATES) -> Dict[str, List[Item]]:
+    """Запрашивает товары всех категорий одновременно и раскладывает лучшие по слотам.
+
+    fetch(category_id) возвращает товары категории; запросы идут через
+    asyncio.gather, так что сбор образа занимает время одного самого
+    долгого запроса. Ошибка одной категории не мешает остальным. Если
+    задана anchor_id (категория, выбранная пользователем), её слот
+    заполняется только её товарами — если их нет или запрос не удался,
+    слот остаётся пустым, а не заполняется другими категориями. Каталоги категорий пересекаются,
+    поэтому товар с тем же _id берётся один раз — из anchor_id, если он
+    есть в ней, иначе из первой по порядку категории.
+    """
+    categories = [category for category in categories if category.get("slot")]
+    # Категория пользователя разбирается первой, чтобы повторы доставались ей
+    categories.sort(key=lambda category: category["id"] != anchor_id)
+    results = await asyncio.gather(*(fetch(category["id"]) for category in categories), return_exceptions=True)
+    candidates: Dict[str, List[Item]] = {}
+    anchor_items: Dict[str, List[Item]] = {category["slot"]: [] for category in categories
+                                           if category["id"] == anchor_id}
+    seen = set()
+    for category, items in zip(categories, results):
+        if isinstance(items, BaseException):
+            logging.error(f"Не удалось получить товары категории {category['id']}: {items!r}")
+            continue
+        unique = []
+        for item in items:
+            if item["_id"] not in seen:
+                seen.add(item["_id"])
+                unique.append(item)
+        items = rank_items(unique, budget, limit)
+        candidates.setdefault(category["slot"], []).extend(items)
+        if category["id"] == anchor_id:
+            anchor_items[category["slot"]] = items
+    candidates.update(anchor_items)
+    return candidates
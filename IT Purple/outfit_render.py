@@ -0,0 +1,114 @@
+import asyncio
+import html
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+# 1. Настройка
+# Сколько лучших товаров показывается пользователю
+OUTFIT_TOP_N = 10
+# Рейтинг товара сглаживается к RATING_PRIOR с весом RATING_PRIOR_WEIGHT отзывов
+RATING_PRIOR = 4.0
+RATING_PRIOR_WEIGHT = 20
+# Telegram принимает не больше 4096 символов текста в сообщении
+MESSAGE_LIMIT = 4096
+# Сообщение с описанием редактируется не чаще раза в столько секунд
+DESCRIPTION_EDIT_INTERVAL = 1.0
+
+ITEMS_HEADER = "<b>Рекомендуемый образ:</b>\n\n"
+DESCRIPTION_HEADER = "<b>Описание от AI:</b>\n"
+
+
+# 2. Отбор товаров
+def rank_scores(ratings: np.ndarray, feedbacks: np.ndarray) -> np.ndarray:
+    """Рейтинги товаров, сглаженные по числу отзывов.
+
+    Пять звёзд у товара с парой отзывов весят меньше, чем 4.8 у товара с
+    тысячей: (rating * feedbacks + RATING_PRIOR * RATING_PRIOR_WEIGHT) /
+    (feedbacks + RATING_PRIOR_WEIGHT).
+    """
+    return (ratings * feedbacks + RATING_PRIOR * RATING_PRIOR_WEIGHT) / (feedbacks + RATING_PRIOR_WEIGHT)
+
+
+def rank_items(items: List[Dict[str, Any]], budget: Optional[float] = None,
+               top_n: int = OUTFIT_TOP_N) -> List[Dict[str, Any]]:
+    """Лучшие top_n товаров не дороже budget по rank_scores.
+
+    При равной оценке сохраняется исходный порядок (у API — по популярности).
+    """
+    if not items:
+        return []
+    count = len(items)
+    prices = np.fromiter((item["price"] for item in items), dtype=float, count=count)
+    ratings = np.fromiter((item.get("rating") or 0 for item in items), dtype=float, count=count)
+    feedbacks = np.fromiter((item.get("feedbacks") or 0 for item in items), dtype=float, count=count)
+    scores = rank_scores(ratings, feedbacks)
+    if budget is not None:
+        scores[prices > budget] = -np.inf
+    order = np.argsort(-scores, kind="stable")[:top_n]
+    return [items[i] for i in order if scores[i] != -np.inf]
+
+
+# 3. Форматирование
+def render_items(items: List[Dict[str, Any]], total: bool = False) -> str:
+    """HTML-сообщение со списком товаров; части собираются в список и склеиваются один раз.
+
+    total добавляет итоговую цену — только для собранного образа, а не для
+    списка альтернатив.
+    """
+    parts = [ITEMS_HEADER]
+    for item in items:
+        parts.append(f"- <a href='{html.escape(item['marketplace_url'])}'>{html.escape(item['name'])}</a>\n")
+        parts.append(f"Цена: {item['price']:.0f} ₽\n")
+        parts.append(f"Описание: {html.escape(str(item['description']))}\n")
+        if item.get("items"):
+            parts.append(f"Состав: {html.escape(', '.join(map(str, item['items'])))}\n")
+        parts.append("\n")
+    if total:
+        parts.append(f"<b>Итого:</b> {sum(item['price'] for item in items):.0f} ₽")
+    return "".join(parts)
+
+
+def render_description(text: str) -> str:
+    """HTML-сообщение с описанием от AI, обрезанное до лимита Telegram."""
+    # Лимит считается по тексту после разбора разметки, поэтому обрезается исходный текст
+    limit = MESSAGE_LIMIT - len("Описание от AI:\n")
+    return DESCRIPTION_HEADER + html.escape(text[:limit], quote=False)
+
+
+# 4. Потоковая доставка
+async def deliver_progressively(chunks: AsyncIterator[str], send: Callable[[str], Awaitable[Any]],
+                                edit: Callable[[Any, str], Awaitable[Any]],
+                                interval: float = DESCRIPTION_EDIT_INTERVAL) -> str:
+    """Показывает потоковый текст одним сообщением, дописывая его по мере генерации.
+
+    Как только появляется непустой текст, send(text) отправляет сообщение и
+    возвращает его; дальше edit(message, text) обновляет его не чаще раза
+    в interval секунд, последний вызов получает весь текст. Если текст
+    пришёл целиком одним куском (например, из кэша), редактирований нет.
+    Возвращает итоговый текст.
+    """
+    loop = asyncio.get_running_loop()
+    parts: List[str] = []
+    message = None
+    shown = ""
+    last_update = 0.0
+    async for chunk in chunks:
+        parts.append(chunk)
+        if message is not None and loop.time() - last_update < interval:
+            continue
+        text = "".join(parts)
+        if not text.strip():
+            continue
+        if message is None:
+            message = await send(text)
+        else:
+            await edit(message, text)
+        shown = text
+        last_update = loop.time()
+    text = "".join(parts)
+    if message is None:
+        await send(text)
+    elif text != shown:
+        await edit(message, text)
+    return text
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, Iterable, Optional
+
+# 1. Настройка
+# Как часто обновляются все категории меню; должно быть заметно меньше
+# срока свежести кэша товаров (CACHE_MAX_AGE в clothing_cache)
+PREFETCH_INTERVAL = 10 * 60
+# Случайное отклонение интервала (доля от него), чтобы процессы бота не
+# обращались к API одновременно
+PREFETCH_JITTER = 0.2
+# Сколько категорий обновляется одновременно
+PREFETCH_CONCURRENCY = 4
+
+
+# 2. Фоновое обновление кэша
+class CatalogPrefetcher:
+    """Периодически обновляет кэш товаров по всем категориям меню.
+
+    categories() возвращает id категорий на текущий момент (меню может
+    поменяться между проходами), refresh(category_id) запрашивает
+    категорию и кладёт товары в кэш, возвращая их число. Проход запускает
+    не больше concurrency запросов одновременно; ошибка одной категории
+    только пишется в лог. Первый проход начинается после случайной
+    задержки до jitter * interval, следующие — через interval ± jitter.
+    """
+
+    def __init__(self, categories: Callable[[], Iterable[str]], refresh: Callable[[str], Awaitable[int]],
+                 interval: float = PREFETCH_INTERVAL, jitter: float = PREFETCH_JITTER,
+                 concurrency: int = PREFETCH_CONCURRENCY):
+        self.categories = categories
+        self.refresh = refresh
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _refresh_one(self, semaphore: asyncio.Semaphore, category_id: str) -> int:
+        async with semaphore:
+            try:
+                return await self.refresh(category_id)
+            except Exception as e:
+                logging.warning(f"Не удалось обновить категорию {category_id}: {e!r}")
+                return 0
+
+    async def run_once(self) -> int:
+        """Обновляет все категории один раз и возвращает число полученных товаров."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        counts = await asyncio.gather(*(self._refresh_one(semaphore, category_id)
+                                        for category_id in self.categories()))
+        logging.info(f"Предзагрузка каталога: {len(counts)} категорий, {sum(counts)} товаров")
+        return sum(counts)
+
+    def _delay(self, base: float) -> float:
+        return max(0.0, base * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def _run(self):
+        await asyncio.sleep(random.uniform(0, self.jitter * self.interval))
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Ошибка предзагрузки каталога")
+            await asyncio.sleep(self._delay(self.interval))
+
+    async def close(self):
+        """Останавливает фоновые проходы."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
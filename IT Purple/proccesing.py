@@ -1,45 +1,101 @@
 import os
 import logging
 import pymongo
-import requests
-from telebot import TeleBot, types
-from transformers import pipeline
-from time import time
-from typing import List, Dict, Any
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from clothing_cache import CACHE_QUERY_LIMIT, CacheWriter, ensure_item_indexes, find_cached_items
+from wildberries import MongoQueryCacheTier, QueryCache, WildberriesAPIError, WildberriesClient
+from llm_backends import make_backend
+from llm_worker import InferenceWorker
+from description_cache import DescriptionCache
+from category_index import CategoryIndex, normalize
+from session_store import SESSION_BACKEND_MONGO, MemorySessionStore, MongoSessionStore, new_session
+from dialog import DialogMachine, InvalidInput, Message, Step, fixed_prompt
+from catalog_query import ProductBatch, build_catalog_query, decode_catalog, normalize_value, select_products
+from outfit_render import deliver_progressively, render_description, render_items
+from outfit_assembler import OUTFIT_CANDIDATES, assemble_outfit, fetch_candidates
+from prefetcher import CatalogPrefetcher
+from keyboards import FORCE_REPLY, FORCE_REPLY_SELECTIVE, KeyboardRegistry, inline_keyboard
+from typing import AsyncIterator, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
-import csv
+import functools
 
 # 1. Настройка
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
-if not TELEGRAM_TOKEN:
-    raise ValueError("Telegram token not found in environment variables.")
 
 MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/")
 DB_NAME = "shopping_assistant"
 CLOTHING_COLLECTION = "clothing_items"
 USER_COLLECTION = "users"
+QUERY_CACHE_COLLECTION = "query_cache"
+# Общий для всех процессов бота уровень кэша запросов к каталогу в MongoDB
+QUERY_CACHE_SHARED = os.environ.get("QUERY_CACHE_SHARED", "0") == "1"
+DESCRIPTION_COLLECTION = "outfit_descriptions"
+# Порог сходства названий товаров, при котором берётся описание похожего образа
+# (None — только точное совпадение)
+DESCRIPTION_NEAR_DUPLICATE = 0.8
+SESSION_COLLECTION = "sessions"
+# Где хранятся сессии диалога: memory (в процессе) или mongo (общие для всех процессов бота)
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
 
-WILDBERRIES_API_URL = "https://catalog.wb.ru/catalog/electronic14/v2/catalog"
 WILDBERRIES_API_TOKEN = os.environ.get("WILDBERRIES_API_TOKEN", "WILDBERRIES_API_TOKEN")
 
-MODEL_NAME = "meta-llama/Llama-2-7b-chat-hf"
+# Бэкенд генерации описаний: transformers (fp32), int8 (динамическое int8-квантование
+# на CPU) или gguf (4-битная модель в llama.cpp, LLM_MODEL — путь к .gguf-файлу).
+# Для CPU-узлов подходит небольшая instruct-модель, например
+# LLM_BACKEND=int8 LLM_MODEL=Qwen/Qwen2.5-1.5B-Instruct
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "transformers")
+MODEL_NAME = os.environ.get("LLM_MODEL", "meta-llama/Llama-2-7b-chat-hf")
+LLM_MAX_NEW_TOKENS = int(os.environ.get("LLM_MAX_NEW_TOKENS", "200"))
 
-bot = TeleBot(TELEGRAM_TOKEN)
+# Прокси для запросов к API Wildberries (пустая строка — без прокси)
+PROXY_URL = os.environ.get("PROXY_URL", "http://bot_proxy:8080")
+
+# Число потоков, в которых идёт генерация LLM
+LLM_WORKERS = 1
+
+# Как часто (в секундах) кэш товаров обновляется по всем категориям меню; 0 — не обновлять
+PREFETCH_INTERVAL = float(os.environ.get("PREFETCH_INTERVAL", "600"))
+
+# Токен проверяется в main(), чтобы модуль можно было импортировать без него
+bot = AsyncTeleBot(TELEGRAM_TOKEN or "", validate_token=False)
 
 # 2. Инициализация LLM
-generator = pipeline("text-generation", model=MODEL_NAME, device_map="auto")
+# Модель загружается в потоке llm_executor при первом запросе или в warm_up()
+llm_backend = make_backend(LLM_BACKEND, MODEL_NAME)
+llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="llm")
+# Промпты из разных чатов генерируются пачками в llm_executor
+llm_worker = InferenceWorker(llm_backend, llm_executor, max_new_tokens=LLM_MAX_NEW_TOKENS)
 
 # 3. Инициализация MongoDB
-client = pymongo.MongoClient(MONGODB_URI)
+# connect=False: соединение откроется при первом запросе, а не при импорте
+client = pymongo.MongoClient(MONGODB_URI, connect=False)
 db = client[DB_NAME]
 clothing_items_collection = db[CLOTHING_COLLECTION]
 users_collection = db[USER_COLLECTION]
+# Запись ответов API в кэш идёт в фоне, вне обработки запроса пользователя
+cache_writer = CacheWriter(clothing_items_collection)
+# Готовые описания образов, чтобы не генерировать их повторно
+description_cache = DescriptionCache(db[DESCRIPTION_COLLECTION], near_duplicate_threshold=DESCRIPTION_NEAR_DUPLICATE)
+# Сессии диалога пользователей
+sessions = MongoSessionStore(db[SESSION_COLLECTION]) if SESSION_BACKEND == SESSION_BACKEND_MONGO \
+    else MemorySessionStore()
+# Если в кэше нашлось не меньше CACHE_MIN_ITEMS подходящих товаров, API не запрашивается
+CACHE_MIN_ITEMS = 5
+
+# Общий клиент API Wildberries с пулом соединений и кэшем запросов
+# Кэш запросов хранит страницы каталога как ProductBatch, в MongoDB — по столбцам
+shared_query_cache = MongoQueryCacheTier(db[QUERY_CACHE_COLLECTION], encode=ProductBatch.to_document,
+                                         decode=ProductBatch.from_document)
+query_cache = QueryCache(shared=shared_query_cache if QUERY_CACHE_SHARED else None)
+wildberries_client = WildberriesClient(proxy=PROXY_URL, cache=query_cache, decode=decode_catalog)
 
 # 4. Логирование
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # 5. Состояния диалога
-user_states: Dict[int, Dict[str, Any]] = {}
 STATE_START = "start"
 STATE_OCCASION = "occasion"
 STATE_CATEGORY = "category"
@@ -52,563 +108,367 @@ STATE_COMPOSITION = "composition"
 STATE_ORIGINAL = "original"
 STATE_SEASON = "season"
 
-proxies = {
-    'http': 'http://bot_proxy:8080',
-    'https': 'https://bot_proxy:8080',
-}
-
 # 6. Функции для работы с CSV
+CATEGORIES_FILE = "wildberries_menu.csv"
+# Меню категорий читается один раз и перечитывается только при изменении файла
+category_index = CategoryIndex(CATEGORIES_FILE)
+
 def load_categories_from_csv(situation: str = None, style: str = None, size: str = None,
-                             age_group: str = None, season: str = None, filename="wildberries_menu.csv"):
-    """Загружает категории одежды из CSV-файла, фильтруя по заданным параметрам."""
-    categories = []
-    with open(filename, 'r', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if situation and row.get("situation") and situation not in row["situation"].split(","):
-                continue
-            if style and row.get("style") and style not in row["style"].split(","):
-                continue
-            if size and row.get("size") and size not in row["size"].split(","):  # Изменили параметр
-                continue
-            if age_group and row.get("age_group") and age_group not in row["age_group"].split(","):
-                continue
-            if season and row.get("season") and season not in row["season"].split(","):
-                continue
-
-            categories.append(row)
-    return categories
+                             age_group: str = None, season: str = None):
+    """Возвращает категории одежды из меню, фильтруя по заданным параметрам."""
+    return category_index.find(situation=situation, style=style, size=size, age_group=age_group, season=season)
 
 # 7. Функции для работы с API Wildberries
 async def get_clothing_items_from_api(category_id: str, style_preferences: List[str], budget: int,
                                        size: str, color: str, composition: str, original: str,
                                        season: str) -> List[Dict[str, Any]]:
-    """Получает готовые образы с API Wildberries."""
-    query_params = {
-        'appType': '1',
-        'curr': 'rub',
-        'dest': '-1185367',
-        'sort': 'popular',
-        'spp': '30',
-        'cat': category_id
-    }
-
-    if style_preferences:
-        query_params["subject"] = ",".join(style_preferences)
+    """Получает готовые образы с API Wildberries.
 
-    query_params = {
-        'appType': '1',
-        'curr': 'rub',
-        'dest': '-1185367',
-        'sort': 'popular',
-        'spp': '30',
-        'cat': category_id
-    }
-
-    headers = {
-        'Accept': '*/*',
-        'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-        'Connection': 'keep-alive',
-        'DNT': '1',
-        'Origin': 'https://www.wildberries.ru',
-        'Referer': 'https://www.wildberries.ru',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'cross-site',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',
-        'sec-ch-ua': '"Not)A;Brand";v="99", "OpenAI Chrome";v="127", "Chromium";v="127"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-    }
+    Бюджет и цвет уходят фильтрами в запрос к каталогу, а select_products
+    ещё раз проверяет цену, размер и цвет и ранжирует товары. Состава,
+    оригинальности и сезона в карточках каталога нет, они учитываются
+    только в описании от LLM.
+    """
+    query_params = build_catalog_query(category_id, budget=budget, color=color)
 
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, requests.get, WILDBERRIES_API_URL, headers=headers, params=query_params, proxies=proxies)
-        response.raise_for_status()
-        data = response.json()
-
-        clothing_items = []
-        for item in data["data"]["products"]:
-            clothing_items.append({
-                "_id": item["id"],
-                "name": item["name"],
-                "description": item["brand"],
-                "price": item["priceU"] / 100,
-                "image_url": item["image"],
-                "marketplace_url": f"https://www.wildberries.ru/catalog/{item['id']}/detail.aspx",
-                "items": [],
-                "last_updated": time()
-            })
-        return clothing_items
-
-    except requests.exceptions.RequestException as e:
+        products = await wildberries_client.get_catalog(query_params)
+        return select_products(products, budget=budget, size=size, color=color).to_items(category_id)
+
+    except WildberriesAPIError as e:
         logging.error(f"Ошибка при запросе к API Wildberries: {e}")
         return []
     except Exception as e:
         logging.exception("Неожиданная ошибка при получении данных из API Wildberries")
         return []
 
+async def prefetch_category(category_id: str) -> int:
+    """Кладёт в кэш товаров первую страницу категории без фильтров пользователя."""
+    # Мимо кэша запросов: устаревший ответ из него записался бы в кэш товаров как свежий
+    products = await wildberries_client.fetch_catalog(build_catalog_query(category_id))
+    clothing_items = products.to_items(category_id)
+    cache_writer.submit(clothing_items)
+    return len(clothing_items)
+
+# Фоновое обновление кэша товаров, чтобы подбор образа обычно читал только MongoDB
+catalog_prefetcher = CatalogPrefetcher(lambda: [category["id"] for category in load_categories_from_csv()],
+                                       prefetch_category, interval=PREFETCH_INTERVAL)
+
 # 8. Функции для работы с базой данных (MongoDB)
-def cache_clothing_items(clothing_items: List[Dict[str, Any]]):
-    """Кэширует образы в MongoDB."""
-    for item in clothing_items:
-        existing_item = clothing_items_collection.find_one({"_id": item["_id"]})
-
-        if existing_item:
-            clothing_items_collection.update_one({"_id": item["_id"]}, {"$set": item})
-            logging.info(f"Обновлен образ {item['name']} в кэше.")
-        else:
-            clothing_items_collection.insert_one(item)
-            logging.info(f"Добавлен образ {item['name']} в кэш.")
-
-def get_cached_clothing_items(occasion: str, style_preferences: List[str], budget: int, body_type: str, age_group: str) -> List[Dict[str, Any]]:
-    """Получает закэшированные образы из MongoDB"""
-    return list(clothing_items_collection.find({}))
+def get_cached_clothing_items(category_id: str, budget: int = None, size: str = None,
+                              color: str = None, limit: int = CACHE_QUERY_LIMIT) -> List[Dict[str, Any]]:
+    """Получает из MongoDB свежие закэшированные образы категории в пределах бюджета, размера и цвета."""
+    return find_cached_items(clothing_items_collection, category_id, budget,
+                             size=normalize_value(size) if size else None,
+                             color=normalize_value(color) if color else None, limit=limit)
 
 # 9. Функции для работы с LLM
-def generate_outfit_description(clothing_items: List[Dict[str, Any]], occasion: str, style_preferences: List[str],
+async def generate_outfit_description(clothing_items: List[Dict[str, Any]], occasion: str, style_preferences: List[str],
                                  size: str, color: str, composition: str, original: str,
-                                 season: str) -> str:
-    """Генерирует описание образа с использованием LLM, учитывая все параметры."""
-    items_str = ", ".join([item['name'] for item in clothing_items])  # Возвращает названия товаров
+                                 season: str) -> AsyncIterator[str]:
+    """Генерирует описание образа с использованием LLM, учитывая все параметры.
+
+    Описание отдаётся кусками по мере генерации; из кэша — целиком одним куском.
+    """
+    item_names = [item['name'] for item in clothing_items]
+    items_str = ", ".join(item_names)  # Возвращает названия товаров
     prompt = f"Опиши стильный образ, подходящий для {occasion}. Он состоит из: {items_str}.  Учитывай стиль: {', '.join(style_preferences)}.  Этот образ размера {size}, цвета {color}, и с составом ткани {composition}.  Только оригинальные товары: {original}.  Подходит для сезона: {season}."
 
+    choices = {"occasion": occasion, "style_preferences": style_preferences, "size": size, "color": color,
+               "composition": composition, "original": original, "season": season}
+    try:
+        description = await asyncio.to_thread(description_cache.lookup, item_names, choices)
+    except Exception:
+        logging.exception("Не удалось прочитать кэш описаний")
+        description = None
+    if description is not None:
+        yield description
+        return
+
     logging.info(f"Prompting LLM: {prompt}")
+    parts = []
     try:
-        result = generator(prompt, max_length=500, num_return_sequences=1, do_sample=True)
-        description = result[0]['generated_text']
+        async for chunk in llm_worker.stream(prompt):
+            parts.append(chunk)
+            yield chunk
     except Exception as e:
         logging.error(f"Error generating description: {e}")
-        description = "Не удалось сгенерировать описание для этого образа."
-    return description
-
-def format_outfit_result(clothing_items: List[Dict[str, Any]], description: str) -> str:
-    """Форматирует результат для отправки пользователю."""
-    message = "<b>Рекомендуемый образ:</b>\n\n"
-    for item in clothing_items:
-        message += f"- <a href='{item['marketplace_url']}'>{item['name']}</a>\n"
-        message += f"Описание: {item['description']}\n"
-        message += f"Состав: {item['items']}\n\n"
-    message += f"\n<b>Описание от AI:</b>\n{description}"
-    return message
-
-def send_outfit_result(chat_id: int, outfit: str):
-    """Отправляет результат пользователю."""
-    bot.send_message(chat_id, outfit, parse_mode="HTML", disable_web_page_preview=True)
-
-# 10. Функции управления интерфейсом (кнопки, сообщения)
-def set_occasion_buttons(chat_id: int):
-    """Предлагает выбор ситуации (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    occasions = ["Прогулка в городе", "Прогулка на природе", "Работа в офисе", "Свидание", "Театр", "Бассейн", "Спортзал","Дом"]
-    for occasion in occasions:
-        item = types.InlineKeyboardButton(occasion, callback_data=f"occasion:{occasion}")
-        markup.add(item)
-
-    # ReplyKeyboard для "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_back)
-
-    bot.send_message(chat_id, "Для какой ситуации вы подбираете образ?", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-
-    user_states[chat_id] = {"history": [], "data": {}}
-    user_states[chat_id]["history"].append({"state": STATE_OCCASION, "data": {}})
-
-def set_category_buttons(chat_id: int, situation: str):
-    """Предлагает выбор категории одежды (InlineKeyboard)."""
-    categories = load_categories_from_csv(situation=situation)  # Фильтруем категории
-    markup = types.InlineKeyboardMarkup()
-    for category in categories:
-        item = types.InlineKeyboardButton(category["name"], callback_data=f"category:{category['id']}")
-        markup.add(item)
-
-    # ReplyKeyboard для "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_back)
-
-    bot.send_message(chat_id, "Выберите категорию одежды:", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Или введите свою:", reply_markup=markup)
-
-    user_states[chat_id]["history"].append({"state": STATE_CATEGORY, "data": {}})
-
-def set_style_preferences_options(chat_id: int):
-    """Запрашивает стилевые предпочтения (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    styles = ["Классический", "Повседневный", "Элегантный", "Спортивный", "Пляжный", "Домашний"]
-    for style in styles:
-        item = types.InlineKeyboardButton(style, callback_data=f"style:{style}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="style:back")
-    markup.add(back_button)
-
-    # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другое")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-
-    bot.send_message(chat_id, "Какие стили вы предпочитаете?", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_STYLE_PREFERENCES, "data": {}})
-
-def set_budget_options(chat_id: int):
-    """Запрашивает бюджет (ForceReply)."""
-    markup = types.ForceReply(selective=False)
-    bot.send_message(chat_id, "Какой у вас бюджет на этот образ (в рублях)?", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_BUDGET, "data": {}})
-
-def set_size_options(chat_id: int):
-    """Запрашивает размер одежды (ForceReply)."""
-    markup = types.ForceReply(selective=False)
-    bot.send_message(chat_id, "Какой у вас размер одежды? Введите число от 38 до 80", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_SIZE, "data": {}})
-
-def set_color_options(chat_id: int):
-    """Предлагает пользователю выбрать цвет (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    colors = ["Черный", "Белый", "Красный", "Синий", "Зеленый", "Желтый"]
-    for color in colors:
-        item = types.InlineKeyboardButton(color, callback_data=f"color:{color}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="color:back")
-    markup.add(back_button)
-
-     # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другой")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-
-    bot.send_message(chat_id, "Какой цвет вы предпочитаете?", reply_markup=markup_reply, reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_COLOR, "data": {}})
-
-def set_composition_options(chat_id: int):
-    """Предлагает пользователю выбрать состав ткани (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    compositions = ["Хлопок", "Шерсть", "Шелк", "Лен", "Синтетика", "Другой"]
-    for composition in compositions:
-        item = types.InlineKeyboardButton(composition, callback_data=f"composition:{composition}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="composition:back")
-    markup.add(back_button)
-
-    # ReplyKeyboard для "Другое" и "Назад"
-    markup_reply = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    item_other = types.KeyboardButton("Другой")
-    item_back = types.KeyboardButton("Назад")
-    markup_reply.add(item_other, item_back)
-
-    bot.send_message(chat_id, "Какой состав ткани вы предпочитаете?", reply_markup=markup_reply,
-                     reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_COMPOSITION, "data": {}})
-
-def set_original_options(chat_id: int):  # Добавили функцию
-    """Предлагает пользователю выбрать, нужен ли оригинальный товар (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    original_options = ["Да", "Нет"]
-    for option in original_options:
-        item = types.InlineKeyboardButton(option, callback_data=f"original:{option}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="original:back")
-    markup.add(back_button)
-    bot.send_message(chat_id, "Нужен ли вам только оригинальный товар?", reply_markup=markup,
-                     reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_ORIGINAL, "data": {}})
-
-def set_season_options(chat_id: int):
-    """Предлагает пользователю выбрать сезон (InlineKeyboard)."""
-    markup = types.InlineKeyboardMarkup()
-    seasons = ["Демисезон","Зима", "Круглогодичный", "Лето", "Сезон не задан"]
-    for season in seasons:
-        item = types.InlineKeyboardButton(season, callback_data=f"season:{season}")
-        markup.add(item)
-    back_button = types.InlineKeyboardButton("Назад", callback_data="season:back")
-    markup.add(back_button)
-
-    bot.send_message(chat_id, "Для какого сезона вы ищете одежду?", reply_markup=markup,
-                     reply_to_message_id=None)
-    bot.send_message(chat_id, "Выберите один из вариантов:", reply_markup=markup)
-    user_states[chat_id]["history"].append({"state": STATE_SEASON, "data": {}})
-
-# 11. Проверка состояния пользователя
-def check_occasion_state(message: types.Message) -> bool:
-    """Проверяет, находится ли пользователь в состоянии выбора ситуации."""
-    chat_id = message.chat.id
-    if not user_states.get(chat_id) or not user_states[chat_id].get("history"):
-        return False
-    return user_states[chat_id]["history"][-1]["state"] == STATE_OCCASION
+        if not parts:
+            yield "Не удалось сгенерировать описание для этого образа."
+        return
+
+    try:
+        await asyncio.to_thread(description_cache.store, item_names, choices, "".join(parts))
+    except Exception:
+        logging.exception("Не удалось сохранить описание в кэш")
+
+async def send_outfit_result(chat_id: int, clothing_items: List[Dict[str, Any]], description: AsyncIterator[str]):
+    """Отправляет список товаров сразу, а описание от AI — следом, дописывая его по мере генерации."""
+    await bot.send_message(chat_id, render_items(clothing_items, total=True), parse_mode="HTML", disable_web_page_preview=True)
+
+    async def send(text: str) -> types.Message:
+        return await bot.send_message(chat_id, render_description(text), parse_mode="HTML")
+
+    async def edit(message: types.Message, text: str):
+        try:
+            await bot.edit_message_text(render_description(text), chat_id=chat_id, message_id=message.message_id,
+                                        parse_mode="HTML")
+        except ApiTelegramException as e:
+            # Пропущенное промежуточное обновление не страшно: следующее покажет весь текст
+            logging.warning(f"Не удалось обновить описание в чате {chat_id}: {e}")
+
+    await deliver_progressively(description, send, edit)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def run_in_background(coro):
+    """Запускает корутину фоновой задачей, не задерживая обработку обновлений."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def get_category_items(category_id: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Товары категории под параметры пользователя: из кэша MongoDB или, если там мало, из API.
+
+    Бюджет здесь только отсекает товары дороже всего образа; как его
+    поделить между слотами, решает assemble_outfit.
+    """
+    clothing_items = await asyncio.to_thread(get_cached_clothing_items, category_id, params["budget"],
+                                             params["size"], params["color"], OUTFIT_CANDIDATES)
+    if len(clothing_items) < CACHE_MIN_ITEMS:
+        clothing_items = await get_clothing_items_from_api(
+            category_id, params["style_preferences"], params["budget"], params["size"],
+            params["color"], params["composition"], params["original"], params["season"])
+        cache_writer.submit(clothing_items)
+    return clothing_items
+
+async def build_and_send_outfit(chat_id: int, params: Dict[str, Any]):
+    """Подбирает образ и отправляет его пользователю.
+
+    Товары запрашиваются одновременно во всех категориях, подходящих для
+    ситуации, и из них собирается образ (верх и низ или вещь целиком,
+    плюс верхняя одежда), суммарно укладывающийся в бюджет; выбранная
+    пользователем категория входит в образ обязательно. Товары каждой
+    категории сначала ищутся в кэше MongoDB, к API идёт запрос, только если
+    подходящих свежих товаров там мало. Запросы к API ограничены пулом
+    соединений wildberries_client, описание генерируется пачками в
+    llm_worker, а запись в MongoDB идёт в фоне через cache_writer, поэтому
+    цикл событий бота не блокируется. Пользователь сразу получает товары
+    образа, а описание дописывается по мере генерации.
+    """
+    try:
+        categories = load_categories_from_csv(situation=params["occasion"])
+        anchor = category_index.get(params["category_id"])
+        if anchor is not None and anchor not in categories:
+            categories.append(anchor)
+        candidates = await fetch_candidates(categories, lambda category_id: get_category_items(category_id, params),
+                                            params["budget"], anchor_id=params["category_id"])
+        anchor_slot = anchor.get("slot") if anchor is not None else None
+        if anchor_slot and not candidates.get(anchor_slot):
+            await bot.send_message(chat_id, f"Не нашлось товаров в категории «{anchor['name']}» в пределах бюджета. "
+                                            "Попробуйте изменить параметры.")
+            return
+        clothing_items = assemble_outfit(candidates, params["budget"], anchor_slot=anchor_slot)
+        if not clothing_items and anchor_slot:
+            await bot.send_message(chat_id, f"Товары из категории «{anchor['name']}» не укладываются в бюджет. "
+                                            "Попробуйте увеличить бюджет или выбрать другую категорию.")
+            return
+        if not clothing_items:
+            await bot.send_message(chat_id, "Не нашлось товаров в пределах бюджета. Попробуйте изменить параметры.")
+            return
+
+        outfit_description = generate_outfit_description(
+            clothing_items, params["occasion"], params["style_preferences"], params["size"],
+            params["color"], params["composition"], params["original"], params["season"])
+        await send_outfit_result(chat_id, clothing_items, outfit_description)
+    except Exception:
+        logging.exception(f"Ошибка при подборе образа для {chat_id}")
+        await bot.send_message(chat_id, "Не удалось подобрать образ. Попробуйте позже.")
+
+# 10. Шаги диалога
+OCCASIONS = ["Прогулка в городе", "Прогулка на природе", "Работа в офисе", "Свидание", "Театр", "Бассейн", "Спортзал", "Дом"]
+STYLES = ["Классический", "Повседневный", "Элегантный", "Спортивный", "Пляжный", "Домашний"]
+COLORS = ["Черный", "Белый", "Красный", "Синий", "Зеленый", "Желтый"]
+COMPOSITIONS = ["Хлопок", "Шерсть", "Шелк", "Лен", "Синтетика"]
+ORIGINAL_OPTIONS = ["Да", "Нет"]
+SEASONS = ["Демисезон", "Зима", "Круглогодичный", "Лето", "Сезон не задан"]
+
+# Клавиатуры шагов строятся и сериализуются один раз при запуске
+keyboards = KeyboardRegistry()
+keyboards.add(STATE_OCCASION, inline_keyboard(STATE_OCCASION, OCCASIONS, other="Другое", back=False))
+keyboards.add(STATE_STYLE_PREFERENCES, inline_keyboard(STATE_STYLE_PREFERENCES, STYLES, other="Другое"))
+keyboards.add(STATE_COLOR, inline_keyboard(STATE_COLOR, COLORS, other="Другой"))
+keyboards.add(STATE_COMPOSITION, inline_keyboard(STATE_COMPOSITION, COMPOSITIONS, other="Другой"))
+keyboards.add(STATE_ORIGINAL, inline_keyboard(STATE_ORIGINAL, ORIGINAL_OPTIONS))
+keyboards.add(STATE_SEASON, inline_keyboard(STATE_SEASON, SEASONS))
+
+def category_keyboard(situation: str) -> str:
+    categories = load_categories_from_csv(situation=situation)
+    return inline_keyboard(STATE_CATEGORY, [(category["name"], category["id"]) for category in categories])
+
+def category_prompt(data: Dict[str, Any]) -> Message:
+    """Выбор категории одежды, подходящей для выбранной ситуации (InlineKeyboard)."""
+    situation = data.get("occasion") or ""
+    # Клавиатура категорий кэшируется по ситуации до изменения файла меню
+    markup = keyboards.dynamic(normalize(situation), lambda: category_keyboard(situation),
+                               version=category_index.version())
+    return "Выберите категорию одежды:", markup
+
+def parse_occasion(text: str, data: Dict[str, Any]) -> str:
+    # Категории с пустой ситуацией подходят для любой, поэтому проверяется,
+    # что ситуация явно указана в меню, а не что по ней что-то нашлось
+    if not category_index.has_value("situation", text):
+        raise InvalidInput("К сожалению, для введенной вами ситуации не найдено подходящих категорий. "
+                           "Пожалуйста, выберите другую ситуацию или категорию.", reprompt=True)
+    return text
+
+def parse_style_preferences(text: str, data: Dict[str, Any]) -> List[str]:
+    return [text]
+
+def parse_budget(text: str, data: Dict[str, Any]) -> int:
+    try:
+        budget = int(text)
+    except ValueError:
+        raise InvalidInput("Пожалуйста, введите бюджет числом.")
+    if budget <= 0:
+        raise InvalidInput("Бюджет должен быть больше нуля.")
+    return budget
+
+# Диалог целиком: шаг -> вопрос, разбор ответа и следующий шаг
+DIALOG_STEPS = [
+    Step(STATE_OCCASION, fixed_prompt("Для какой ситуации вы подбираете образ?", keyboards[STATE_OCCASION]),
+         STATE_CATEGORY, parse=parse_occasion,
+         other=("Другое", ("Пожалуйста, введите свой вариант ситуации:", FORCE_REPLY_SELECTIVE))),
+    Step(STATE_CATEGORY, category_prompt, STATE_STYLE_PREFERENCES, field="category_id", text_input=False),
+    Step(STATE_STYLE_PREFERENCES, fixed_prompt("Какие стили вы предпочитаете?", keyboards[STATE_STYLE_PREFERENCES]),
+         STATE_BUDGET, parse=parse_style_preferences,
+         other=("Другое", ("Пожалуйста, введите свой вариант стиля:", FORCE_REPLY_SELECTIVE))),
+    Step(STATE_BUDGET, fixed_prompt("Какой у вас бюджет на этот образ (в рублях)?", FORCE_REPLY),
+         STATE_SIZE, parse=parse_budget),
+    Step(STATE_SIZE, fixed_prompt("Какой у вас размер одежды? Введите число от 38 до 80", FORCE_REPLY), STATE_COLOR),
+    Step(STATE_COLOR, fixed_prompt("Какой цвет вы предпочитаете?", keyboards[STATE_COLOR]), STATE_COMPOSITION,
+         other=("Другой", ("Пожалуйста, введите предпочитаемый цвет", None))),
+    Step(STATE_COMPOSITION, fixed_prompt("Какой состав ткани вы предпочитаете?", keyboards[STATE_COMPOSITION]),
+         STATE_ORIGINAL, other=("Другой", ("Пожалуйста, введите предпочитаемый состав ткани", None))),
+    Step(STATE_ORIGINAL, fixed_prompt("Нужен ли вам только оригинальный товар?", keyboards[STATE_ORIGINAL]),
+         STATE_SEASON, text_input=False),
+    Step(STATE_SEASON, fixed_prompt("Для какого сезона вы ищете одежду?", keyboards[STATE_SEASON]),
+         None, text_input=False),
+]
+
+async def send_dialog_message(chat_id: int, text: str, markup: Any):
+    await bot.send_message(chat_id, text, reply_markup=markup)
+
+async def start_outfit_search(chat_id: int, data: Dict[str, Any]):
+    """Завершение диалога: запускает подбор образа по собранным ответам."""
+    params = {
+        "occasion": data.get("occasion"),
+        "category_id": data.get("category_id"),
+        "style_preferences": data.get("style_preferences", []),
+        "budget": data.get("budget"),
+        "size": data.get("size"),
+        "color": data.get("color"),
+        "composition": data.get("composition"),
+        "original": data.get("original"),
+        "season": data.get("season"),
+    }
+    await bot.send_message(chat_id, "Подбираю образ, это займёт немного времени...")
+    # Запрос к API и генерация описания идут в фоне
+    run_in_background(build_and_send_outfit(chat_id, params))
+
+dialog = DialogMachine(DIALOG_STEPS, send_dialog_message, start_outfit_search)
+
+# 11. Сессии пользователей
+def with_session(handler):
+    """Загружает сессию чата перед обработчиком и сохраняет её после него.
+
+    Без сессии кнопка значит, что сессия устарела, а текст — что диалог
+    ещё не начат; в обоих случаях пользователь получает подсказку про /start.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update):
+        message = update.message if isinstance(update, types.CallbackQuery) else update
+        chat_id = message.chat.id
+        session = await sessions.get(chat_id)
+        if session is None:
+            if isinstance(update, types.CallbackQuery):
+                await bot.answer_callback_query(update.id)
+                await bot.send_message(chat_id, "Сессия устарела. Отправьте /start, чтобы начать заново.")
+            else:
+                await bot.send_message(chat_id, "Чтобы подобрать образ, отправьте /start.")
+            return
+        await handler(update, session)
+        await sessions.save(chat_id, session)
+    return wrapper
 
 # 12. Обработчики сообщений и callback-запросов
 @bot.message_handler(commands=['start'])
-def handle_start(message: types.Message):
+async def handle_start(message: types.Message):
     """Обработчик команды /start."""
     chat_id = message.chat.id
     logging.info(f"Handling /start command for chat_id: {chat_id}")
     # Добавляем приветственное сообщение
-    bot.send_message(chat_id, "Привет! Я помогу тебе подобрать стильный образ. Давай начнем!")
-    set_occasion_buttons(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("occasion"))
-def handle_occasion_inline(call: types.CallbackQuery):
-    """Обработчик выбора ситуации (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    occasion = call.data.split(":")[1]
-    user_states[chat_id]["data"]["occasion"] = occasion
-    set_category_buttons(chat_id, occasion)
-    bot.answer_callback_query(call.id)
-    logging.info(f"User {chat_id} selected occasion: {occasion}")
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_OCCASION)
-def handle_occasion(message: types.Message):
-    """Обработчик ввода с клавиатуры (Другое или Назад)."""
-    chat_id = message.chat.id
-    occasion_text = message.text
-    if occasion_text == "Другое":
-        bot.send_message(chat_id, "Пожалуйста, введите свой вариант ситуации:",
-                         reply_markup=types.ForceReply(selective=True))
-    elif occasion_text == "Назад":
-        handle_back(chat_id)
-    else:
-        user_states[chat_id]["data"]["occasion"] = occasion_text
-        categories = load_categories_from_csv(situation=occasion_text)
-
-        if not categories:
-            bot.send_message(chat_id,
-                             "К сожалению, для введенной вами ситуации не найдено подходящих категорий. Пожалуйста, выберите другую ситуацию или категорию.")
-            set_occasion_buttons(chat_id)
-            return
-
-        set_category_buttons(chat_id, occasion_text)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("category"))
-def handle_category_inline(call: types.CallbackQuery):
-    """Обработчик выбора категории одежды (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    category_id = call.data.split(":")[1]
-    user_states[chat_id]["data"]["category_id"] = category_id
-    set_style_preferences_options(chat_id)
-    bot.answer_callback_query(call.id)
-    logging.info(f"User {chat_id} selected category: {category_id}")
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_STYLE_PREFERENCES)
-def handle_style_preferences(message: types.Message):
-    """Обработчик ввода с клавиатуры (Другое или Назад)."""
-    chat_id = message.chat.id
-    style_text = message.text
-    if style_text == "Другое":
-        bot.send_message(chat_id, "Пожалуйста, введите свой вариант стиля:", reply_markup=types.ForceReply(selective=True))
-    elif style_text == "Назад":
-        handle_back(chat_id)
-    else:
-        user_states[chat_id]["data"]["style_preferences"] = [style_text]
-        set_budget_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("style"))
-def handle_style_inline(call: types.CallbackQuery):
-    """Обработчик выбора стиля (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    style = call.data.split(":")[1]
-    if call.data == "style:back":
-        handle_back(chat_id)
-        return
-    if "style_preferences" not in user_states[chat_id]["data"]:
-        user_states[chat_id]["data"]["style_preferences"] = [style]
-    else:
-        user_states[chat_id]["data"]["style_preferences"].append(style)
-    set_budget_options(chat_id)
-    bot.answer_callback_query(call.id)
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_BUDGET)
-async def handle_budget(message: types.Message):
-    chat_id = message.chat.id
-    budget = message.text
+    await bot.send_message(chat_id, "Привет! Я помогу тебе подобрать стильный образ. Давай начнем!")
+    session = new_session()
+    await dialog.start(chat_id, session)
+    await sessions.save(chat_id, session)
+
+@bot.message_handler(func=lambda message: message.text.startswith("/"))
+async def handle_unknown_command(message: types.Message):
+    """Другие команды не обрабатываются и не считаются ответом на шаг диалога."""
+    logging.info(f"Ignoring unknown command {message.text.split()[0]!r} from chat_id: {message.chat.id}")
+
+@bot.callback_query_handler(func=lambda call: True)
+@with_session
+async def handle_choice(call: types.CallbackQuery, session: Dict[str, Any]):
+    """Нажатие инлайн-кнопки; callback_data имеет вид «состояние:значение»."""
+    await bot.answer_callback_query(call.id)
+    state, _, value = call.data.partition(":")
+    await dialog.handle_choice(call.message.chat.id, session, state, value)
+
+@bot.message_handler(content_types=['text'])
+@with_session
+async def handle_text(message: types.Message, session: Dict[str, Any]):
+    """Текстовый ответ на текущий шаг диалога."""
+    await dialog.handle_text(message.chat.id, session, message.text)
+
+# 13. Запуск бота
+async def warm_up():
+    """Готовит бота к работе в фоне: создаёт индексы MongoDB, запускает предзагрузку каталога и загружает модель.
+
+    Бот принимает обновления сразу после запуска, запросы до окончания
+    загрузки модели просто дождутся её.
+    """
     try:
-        budget = int(budget)
-        user_states[chat_id]["data"]["budget"] = budget
-        set_size_options(chat_id)  #
-    except ValueError:
-        bot.send_message(chat_id, "Пожалуйста, введите бюджет числом.")
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_SIZE)
-async def handle_size(message: types.Message):
-    chat_id = message.chat.id
-    size = message.text
-    user_states[chat_id]["data"]["size"] = size
-    set_color_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("color"))
-def handle_color_inline(call: types.CallbackQuery):
-    """Обработчик выбора цвета (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    color = call.data.split(":")[1]
-    if call.data == "color:back":
-        handle_back(chat_id)
-        return
-
-    # Проверяем, есть ли вариант "Другое" и если да, то просим ввести цвет
-    if color == "Другой":
-        bot.send_message(chat_id, "Пожалуйста, введите предпочитаемый цвет")
-    else:
-        user_states[chat_id]["data"]["color"] = color
-        set_composition_options(chat_id)
-        bot.answer_callback_query(call.id)
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_COLOR)
-async def handle_color(message: types.Message):
-    chat_id = message.chat.id
-    color = message.text
-    user_states[chat_id]["data"]["color"] = color
-    set_composition_options(chat_id)
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_COMPOSITION)
-async def handle_composition(message: types.Message):
-    chat_id = message.chat.id
-    composition = message.text
-    user_states[chat_id]["data"]["composition"] = composition
-    set_original_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("original"))
-def handle_original_inline(call: types.CallbackQuery):
-    """Обработчик выбора оригинальности товара (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    original = call.data.split(":")[1]
-    if call.data == "original:back":
-        handle_back(chat_id)
-        return
-    user_states[chat_id]["data"]["original"] = original
-    set_season_options(chat_id)
-    bot.answer_callback_query(call.id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("color"))
-def handle_color_inline(call: types.CallbackQuery):
-    """Обработчик выбора цвета (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    color = call.data.split(":")[1]
-    if call.data == "color:back":
-        handle_back(chat_id)
-        return
-
-    # Проверяем, есть ли вариант "Другое" и если да, то просим ввести цвет
-    if color == "Другой":
-        bot.send_message(chat_id, "Пожалуйста, введите предпочитаемый цвет")
-    else:
-        user_states[chat_id]["data"]["color"] = color
-        set_composition_options(chat_id)
-        bot.answer_callback_query(call.id)
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_COLOR)
-async def handle_color(message: types.Message):
-    chat_id = message.chat.id
-    color = message.text
-    user_states[chat_id]["data"]["color"] = color
-    set_composition_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("composition"))
-def handle_composition_inline(call: types.CallbackQuery):
-    """Обработчик выбора состава (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    composition = call.data.split(":")[1]
-    if call.data == "composition:back":
-        handle_back(chat_id)
-        return
-
-    # Проверяем, есть ли вариант "Другое" и если да, то просим ввести цвет
-    if composition == "Другой":
-        bot.send_message(chat_id, "Пожалуйста, введите предпочитаемый состав ткани")
+        await asyncio.to_thread(ensure_item_indexes, clothing_items_collection)
+        await asyncio.to_thread(description_cache.ensure_indexes)
+        if isinstance(sessions, MongoSessionStore):
+            await asyncio.to_thread(sessions.ensure_indexes)
+    except Exception:
+        logging.exception("Не удалось создать индексы MongoDB")
+    if PREFETCH_INTERVAL > 0:
+        catalog_prefetcher.start()
+    try:
+        await llm_worker.warm_up()
+    except Exception:
+        logging.exception("Не удалось загрузить модель, загрузка повторится при первом запросе")
     else:
-        user_states[chat_id]["data"]["composition"] = composition
-        set_original_options(chat_id)
-        bot.answer_callback_query(call.id)
-
-@bot.message_handler(func=lambda message: message.text and user_states.get(message.chat.id) and user_states[message.chat.id]["history"][-1]["state"] == STATE_COMPOSITION)
-async def handle_composition(message: types.Message):
-    chat_id = message.chat.id
-    composition = message.text
-    user_states[chat_id]["data"]["composition"] = composition
-    set_original_options(chat_id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("original"))
-def handle_original_inline(call: types.CallbackQuery):
-    """Обработчик выбора оригинальности товара (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    original = call.data.split(":")[1]
-    if call.data == "original:back":
-        handle_back(chat_id)
-        return
-    user_states[chat_id]["data"]["original"] = original
-    set_season_options(chat_id)
-    bot.answer_callback_query(call.id)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("season"))
-async def handle_season_inline(call: types.CallbackQuery):
-    """Обработчик выбора сезона (InlineKeyboard)."""
-    chat_id = call.message.chat.id
-    season = call.data.split(":")[1]
-
-    # Получаем параметры для API
-    occasion = user_states[chat_id]["data"].get("occasion")
-    category_id = user_states[chat_id]["data"].get("category_id")
-    style_preferences = user_states[chat_id]["data"].get("style_preferences", [])
-    budget = user_states[chat_id]["data"].get("budget")
-    size = user_states[chat_id]["data"].get("size")
-    color = user_states[chat_id]["data"].get("color")
-    composition = user_states[chat_id]["data"].get("composition")
-    original = user_states[chat_id]["data"].get("original")
-    season = season
-
-    # Запрашиваем образы с API
-    clothing_items = await get_clothing_items_from_api(category_id, style_preferences, budget, size, color, composition, original, season)
-
-    cache_clothing_items(clothing_items)
-
-    # Генерируем описание образа
-    outfit_description = generate_outfit_description(clothing_items, occasion, style_preferences, size, color, composition, original, season)
-
-    # Форматируем и отправляем результат
-    outfit_result = format_outfit_result(clothing_items, outfit_description)
-    send_outfit_result(chat_id, outfit_result)
-    bot.answer_callback_query(call.id)
-
-#13. Обработчики ввода сообщений
-def handle_back(chat_id: int):
-    """Обработчик для кнопки "Назад"."""
-    if chat_id not in user_states:
-        bot.send_message(chat_id, "Вы в самом начале диалога. Некуда возвращаться.")
-        return
+        logging.info("Бот готов к работе")
 
-    if len(user_states[chat_id]["history"]) > 1:
-        user_states[chat_id]["history"].pop()
-        previous_state = user_states[chat_id]["history"][-1]["state"]
-        if previous_state == STATE_OCCASION:
-            set_occasion_buttons(chat_id)
-        elif previous_state == STATE_CATEGORY:
-            set_category_buttons(chat_id, user_states[chat_id]["data"].get("occasion"))
-        elif previous_state == STATE_STYLE_PREFERENCES:
-            set_style_preferences_options(chat_id)
-        elif previous_state == STATE_BUDGET:
-            set_budget_options(chat_id)
-        elif previous_state == STATE_SIZE:
-            set_size_options(chat_id)
-        elif previous_state == STATE_COLOR:
-            set_color_options(chat_id)
-        elif previous_state == STATE_COMPOSITION:
-            set_composition_options(chat_id)
-        elif previous_state == STATE_ORIGINAL:
-            set_original_options(chat_id)
-        elif previous_state == STATE_SEASON:
-            set_season_options(chat_id)
-        else:
-            bot.send_message(chat_id, "Неизвестное предыдущее состояние.")
-    else:
-        bot.send_message(chat_id, "Вы в самом начале диалога.")
+async def main():
+    if not TELEGRAM_TOKEN:
+        raise ValueError("Telegram token not found in environment variables.")
+    run_in_background(warm_up())
+    try:
+        await bot.polling(non_stop=True)
+    finally:
+        await llm_worker.close()
+        await catalog_prefetcher.close()
+        await cache_writer.close()
+        await wildberries_client.close()
 
-# 14. Запуск бота
 if __name__ == "__main__":
     logging.info("Starting Telegram bot...")
-    asyncio.run(bot.polling(none_stop=True))
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
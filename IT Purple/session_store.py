@@ -0,0 +1,112 @@
+import asyncio
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Any, Dict, Optional
+
+# 1. Настройка
+# Сессия без действий пользователя дольше SESSION_TTL секунд удаляется
+SESSION_TTL = 24 * 60 * 60
+# Сколько сессий держит в памяти MemorySessionStore
+SESSION_MAX_ENTRIES = 10000
+
+SESSION_BACKEND_MEMORY = "memory"
+SESSION_BACKEND_MONGO = "mongo"
+
+
+# 2. Состояние диалога
+# Сессия — {"history": [состояния по порядку], "data": {ответы пользователя}}.
+# В history хранятся только имена состояний, и каждое встречается не больше
+# одного раза, поэтому история не длиннее числа шагов диалога.
+def new_session() -> Dict[str, Any]:
+    return {"history": [], "data": {}}
+
+
+def push_state(session: Dict[str, Any], state: str):
+    """Делает state текущим шагом; при возврате к пройденному шагу история обрезается."""
+    history = session["history"]
+    if state in history:
+        del history[history.index(state):]
+    history.append(state)
+
+
+def current_state(session: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not session or not session["history"]:
+        return None
+    return session["history"][-1]
+
+
+def dump_session(session: Dict[str, Any]) -> str:
+    """Компактная сериализация сессии для постоянного хранилища."""
+    return json.dumps({"h": session["history"], "d": session["data"]}, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_session(raw: str) -> Dict[str, Any]:
+    state = json.loads(raw)
+    return {"history": state["h"], "data": state["d"]}
+
+
+# 3. Хранилища
+# Интерфейс хранилищ одинаковый: get(chat_id) возвращает сессию или None,
+# save(chat_id, session) сохраняет изменённую сессию, delete(chat_id) удаляет.
+class MemorySessionStore:
+    """Сессии в памяти процесса: LRU на max_entries чатов и TTL от последнего сохранения."""
+
+    def __init__(self, max_entries: int = SESSION_MAX_ENTRIES, ttl: float = SESSION_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._sessions: "OrderedDict[int, tuple]" = OrderedDict()
+
+    async def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        entry = self._sessions.get(chat_id)
+        if entry is None:
+            return None
+        expires_at, session = entry
+        if expires_at < monotonic():
+            del self._sessions[chat_id]
+            return None
+        self._sessions.move_to_end(chat_id)
+        return session
+
+    async def save(self, chat_id: int, session: Dict[str, Any]):
+        self._sessions[chat_id] = (monotonic() + self.ttl, session)
+        self._sessions.move_to_end(chat_id)
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+
+    async def delete(self, chat_id: int):
+        self._sessions.pop(chat_id, None)
+
+
+class MongoSessionStore:
+    """Сессии в коллекции MongoDB, общие для всех процессов бота.
+
+    Сессия хранится строкой dump_session, устаревшие документы удаляет
+    сама MongoDB по TTL-индексу на поле expires_at.
+    """
+
+    def __init__(self, collection, ttl: float = SESSION_TTL):
+        self.collection = collection
+        self.ttl = ttl
+
+    def ensure_indexes(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def _get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        document = self.collection.find_one({"_id": chat_id, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+        return load_session(document["s"]) if document is not None else None
+
+    def _save(self, chat_id: int, session: Dict[str, Any]):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        self.collection.replace_one({"_id": chat_id}, {"_id": chat_id, "s": dump_session(session),
+                                                       "expires_at": expires_at}, upsert=True)
+
+    async def get(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, chat_id)
+
+    async def save(self, chat_id: int, session: Dict[str, Any]):
+        await asyncio.to_thread(self._save, chat_id, session)
+
+    async def delete(self, chat_id: int):
+        await asyncio.to_thread(self.collection.delete_one, {"_id": chat_id})
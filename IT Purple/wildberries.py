@@ -0,0 +1,276 @@
+import os
+import asyncio
+import hashlib
+import json
+import logging
+import random
+from collections import OrderedDict
+from datetime import datetime, timezone
+from time import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import aiohttp
+
+# 1. Настройка
+WILDBERRIES_API_URL = os.environ.get("WILDBERRIES_API_URL", "https://catalog.wb.ru/catalog/electronic14/v2/catalog")
+
+# Пул соединений: не больше API_CONNECTIONS_PER_HOST одновременных запросов
+# к одному хосту, остальные ждут свободного соединения
+API_CONNECTIONS_PER_HOST = 20
+API_KEEPALIVE_TIMEOUT = 60
+API_TIMEOUT = 10
+# Повторы с экспоненциальной задержкой при сетевых ошибках и ответах 429/5xx
+API_RETRIES = 3
+API_BACKOFF = 0.5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Кэш ответов каталога: свежая запись отдаётся без запроса, устаревшая ещё
+# CACHE_STALE_TTL секунд отдаётся сразу, а в фоне обновляется
+CACHE_TTL = 15 * 60
+CACHE_STALE_TTL = 60 * 60
+CACHE_MAX_ENTRIES = 256
+
+WILDBERRIES_HEADERS = {
+    'Accept': '*/*',
+    'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'DNT': '1',
+    'Origin': 'https://www.wildberries.ru',
+    'Referer': 'https://www.wildberries.ru',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'cross-site',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36',
+    'sec-ch-ua': '"Not)A;Brand";v="99", "Google Chrome";v="127", "Chromium";v="127"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+}
+
+
+class WildberriesAPIError(Exception):
+    """Запрос к API Wildberries не удался (в том числе после всех повторов)."""
+
+
+class RetryableStatus(WildberriesAPIError):
+    """Ответ API со статусом, после которого запрос стоит повторить."""
+
+    def __init__(self, status: int):
+        super().__init__(f"API Wildberries ответил {status}")
+        self.status = status
+
+
+# 2. Кэш запросов к каталогу
+class MongoQueryCacheTier:
+    """Общий уровень кэша запросов в коллекции MongoDB.
+
+    Позволяет нескольким процессам бота делить ответы каталога.
+    Записи удаляются самой MongoDB по TTL-индексу на поле expires_at.
+    encode и decode переводят значение кэша в документ MongoDB и обратно,
+    если оно не хранится как есть (например, ProductBatch).
+    """
+
+    def __init__(self, collection, encode: Optional[Callable[[Any], Any]] = None,
+                 decode: Optional[Callable[[Any], Any]] = None):
+        self.collection = collection
+        self.encode = encode
+        self.decode = decode
+        self._index_ready = False
+
+    def _ensure_index(self):
+        if not self._index_ready:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self._index_ready = True
+
+    def _get(self, key: str) -> Optional[Tuple[float, Any]]:
+        self._ensure_index()
+        document = self.collection.find_one({"_id": key})
+        if document is None:
+            return None
+        value = document["value"]
+        return document["stored_at"], self.decode(value) if self.decode else value
+
+    def _set(self, key: str, stored_at: float, value: Any, keep_for: float):
+        self._ensure_index()
+        expires_at = datetime.fromtimestamp(stored_at + keep_for, tz=timezone.utc)
+        if self.encode:
+            value = self.encode(value)
+        self.collection.replace_one(
+            {"_id": key},
+            {"_id": key, "stored_at": stored_at, "expires_at": expires_at, "value": value},
+            upsert=True,
+        )
+
+    async def get(self, key: str) -> Optional[Tuple[float, Any]]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, stored_at: float, value: Any, keep_for: float):
+        await asyncio.to_thread(self._set, key, stored_at, value, keep_for)
+
+
+class QueryCache:
+    """Кэш ответов каталога по нормализованным параметрам запроса.
+
+    Локальный уровень — LRU на max_entries записей в памяти процесса,
+    необязательный общий уровень (например, MongoQueryCacheTier) проверяется
+    при промахе. Запись моложе ttl отдаётся как есть; запись моложе
+    ttl + stale_ttl тоже отдаётся сразу, но обновляется в фоне.
+    Одновременные промахи по одному ключу делают один запрос к API.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, stale_ttl: float = CACHE_STALE_TTL,
+                 max_entries: int = CACHE_MAX_ENTRIES, shared=None):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.shared = shared
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def make_key(params: Dict[str, Any]) -> str:
+        """Ключ кэша: параметры без пустых значений, приведённые к строкам и отсортированные."""
+        normalized = sorted(
+            (str(name).strip(), str(value).strip())
+            for name, value in params.items()
+            if value is not None and str(value).strip() != ""
+        )
+        return hashlib.sha1(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, stored_at: float, value: Any):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _lookup(self, key: str) -> Optional[Tuple[float, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self.shared is not None:
+            try:
+                entry = await self.shared.get(key)
+            except Exception:
+                logging.exception("Не удалось прочитать общий кэш запросов")
+                entry = None
+            if entry is not None:
+                self._remember(key, *entry)
+        return entry
+
+    async def _fetch(self, key: str, params: Dict[str, Any],
+                     fetch: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Any:
+        value = await fetch(params)
+        stored_at = time()
+        self._remember(key, stored_at, value)
+        if self.shared is not None:
+            try:
+                await self.shared.set(key, stored_at, value, self.ttl + self.stale_ttl)
+            except Exception:
+                logging.exception("Не удалось записать общий кэш запросов")
+        return value
+
+    def _refresh(self, key: str, params: Dict[str, Any],
+                 fetch: Callable[[Dict[str, Any]], Awaitable[Any]]) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, params, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def get_or_fetch(self, params: Dict[str, Any],
+                           fetch: Callable[[Dict[str, Any]], Awaitable[Any]]) -> Any:
+        key = self.make_key(params)
+        entry = await self._lookup(key)
+        if entry is not None:
+            stored_at, value = entry
+            age = time() - stored_at
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                if key not in self._inflight:
+                    self._refresh(key, params, fetch).add_done_callback(_log_refresh_error)
+                return value
+        return await asyncio.shield(self._refresh(key, params, fetch))
+
+    def invalidate(self, params: Dict[str, Any]):
+        self._entries.pop(self.make_key(params), None)
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Фоновое обновление кэша запросов не удалось: {task.exception()}")
+
+
+# 3. Клиент API каталога
+class WildberriesClient:
+    """Общий асинхронный клиент API каталога Wildberries.
+
+    Держит одну aiohttp-сессию с пулом keep-alive соединений, поэтому
+    запросы не открывают каждый раз новое TCP/TLS-соединение через прокси.
+    Сессия создаётся при первом запросе внутри работающего цикла событий.
+    Если передан cache (QueryCache), ответы каталога берутся из него.
+    decode разбирает тело ответа (bytes); по умолчанию это json.loads,
+    боты передают catalog_query.decode_catalog.
+    """
+
+    def __init__(self, base_url: str = WILDBERRIES_API_URL, proxy: Optional[str] = None,
+                 connections_per_host: int = API_CONNECTIONS_PER_HOST, timeout: float = API_TIMEOUT,
+                 retries: int = API_RETRIES, backoff: float = API_BACKOFF,
+                 cache: Optional[QueryCache] = None, decode: Callable[[bytes], Any] = json.loads):
+        self.base_url = base_url
+        self.cache = cache
+        self.decode = decode
+        self.proxy = proxy or None
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.connections_per_host,
+                keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=WILDBERRIES_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def get_catalog(self, params: Dict[str, Any]) -> Any:
+        """Возвращает страницу каталога: из кэша, если он есть, иначе из API."""
+        if self.cache is not None:
+            return await self.cache.get_or_fetch(params, self.fetch_catalog)
+        return await self.fetch_catalog(params)
+
+    async def fetch_catalog(self, params: Dict[str, Any]) -> Any:
+        """Запрашивает страницу каталога у API и возвращает тело ответа, разобранное decode.
+
+        Сетевые ошибки, таймауты и ответы 429/5xx повторяются до retries раз
+        с экспоненциальной задержкой и случайным разбросом. Если запрос так
+        и не удался, выбрасывается WildberriesAPIError.
+        """
+        session = self._get_session()
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(self.base_url, params=params, proxy=self.proxy) as response:
+                    if response.status in RETRY_STATUSES:
+                        raise RetryableStatus(response.status)
+                    response.raise_for_status()
+                    return self.decode(await response.read())
+            except aiohttp.ClientResponseError as e:
+                raise WildberriesAPIError(f"API Wildberries ответил {e.status}") from e
+            except (aiohttp.ClientError, asyncio.TimeoutError, RetryableStatus) as e:
+                if attempt == self.retries:
+                    raise WildberriesAPIError(f"Запрос к API Wildberries не удался: {e!r}") from e
+                delay = self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+                logging.warning(f"Запрос к API Wildberries не удался ({e!r}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()